@@ -4,11 +4,12 @@ import re
 
 from NEMO.mixins import ModelAdminRedirectMixin
 from NEMO.models import User
-from NEMO.utilities import copy_media_file, new_model_copy
+from NEMO.utilities import copy_media_file, export_format_datetime, new_model_copy
 from NEMO.widgets.dynamic_form import admin_render_dynamic_form_preview
 from django import forms
 from django.contrib import admin, messages
 from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
@@ -21,13 +22,25 @@ from NEMO_custom_forms.models import (
     CustomFormDisplayColumn,
     CustomFormDocumentType,
     CustomFormDocuments,
+    CustomFormNumberSequence,
     CustomFormPDFTemplate,
     CustomFormSpecialMapping,
     re_ends_with_number,
 )
+from NEMO_custom_forms.rendering import stream_custom_form_pdfs_zip
 from NEMO_custom_forms.utilities import custom_forms_current_numbers
 
 
+@admin.action(description="Download selected forms as a zip file")
+def download_custom_form_pdfs(modeladmin, request, queryset):
+    response = StreamingHttpResponse(
+        stream_custom_form_pdfs_zip(queryset.select_related("template").iterator(chunk_size=100)),
+        content_type="application/zip",
+    )
+    response["Content-Disposition"] = f'attachment; filename="custom_forms_{export_format_datetime()}.zip"'
+    return response
+
+
 @admin.action(description="Duplicate selected templates")
 def duplicate_custom_form_template(modeladmin, request, queryset):
     for template in queryset.all():
@@ -213,6 +226,7 @@ class CustomFormAdmin(admin.ModelAdmin):
         "cancelled",
     ]
     date_hierarchy = "last_updated"
+    actions = [download_custom_form_pdfs]
 
     def delete_queryset(self, request, queryset):
         # This is needed so that the notifications for these forms are also deleted
@@ -262,3 +276,14 @@ class CustomFormAutomaticNumberingAdmin(admin.ModelAdmin):
             return mark_safe(f'Current form numbers:<ul style="margin-left: 20px">{display_list}</ul>')
         else:
             return "No current form numbers recorded"
+
+
+@admin.register(CustomFormNumberSequence)
+class CustomFormNumberSequenceAdmin(admin.ModelAdmin):
+    list_display = ["name", "template", "current_number"]
+    list_filter = [("template", admin.RelatedOnlyFieldListFilter)]
+    search_fields = ["name"]
+
+    def get_readonly_fields(self, request, obj=None):
+        # The name identifies the sequence, only its current number can be changed (i.e. to reset it)
+        return ["template", "name"] if obj else []
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.20 on 2026-10-17 00:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO_custom_forms", "0006_customformactionrecord_action_name"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customformpdftemplate",
+            name="pdf_form_catalog",
+            field=models.JSONField(
+                blank=True,
+                editable=False,
+                help_text="The pdf form fields and widgets, extracted when the pdf form is uploaded",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.20 on 2026-10-17 00:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_next_action_ranks(apps, schema_editor):
+    CustomForm = apps.get_model("NEMO_custom_forms", "CustomForm")
+    CustomFormAction = apps.get_model("NEMO_custom_forms", "CustomFormAction")
+    CustomFormActionRecord = apps.get_model("NEMO_custom_forms", "CustomFormActionRecord")
+    CustomForm.objects.update(
+        next_action_rank=models.Subquery(
+            CustomFormAction.objects.filter(template_id=models.OuterRef("template_id"))
+            .exclude(
+                rank__in=CustomFormActionRecord.objects.filter(
+                    custom_form_id=models.OuterRef(models.OuterRef("pk"))
+                ).values("action_rank")
+            )
+            .order_by("rank")
+            .values("rank")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO_custom_forms", "0007_customformpdftemplate_pdf_form_catalog"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customform",
+            name="next_action_rank",
+            field=models.PositiveIntegerField(
+                blank=True,
+                editable=False,
+                help_text="The rank of the next action to take on this form (kept up to date from its action records).",
+                null=True,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="customform",
+            index=models.Index(fields=["template", "status", "next_action_rank"], name="customform_next_action_rank"),
+        ),
+        migrations.RunPython(set_next_action_ranks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.20 on 2026-10-17 00:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO_custom_forms", "0008_customform_next_action_rank"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customform",
+            index=models.Index(
+                condition=models.Q(("cancelled", False)),
+                fields=["template", "-last_updated"],
+                name="customform_active_by_template",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="customform",
+            index=models.Index(
+                condition=models.Q(("cancelled", False)),
+                fields=["template", "creator", "-last_updated"],
+                name="customform_active_by_creator",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="customform",
+            index=models.Index(
+                condition=models.Q(("cancelled", False)),
+                fields=["template", "status", "-last_updated"],
+                name="customform_active_by_status",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="customformactionrecord",
+            index=models.Index(fields=["custom_form", "action_rank"], name="customformrecord_form_rank"),
+        ),
+    ]
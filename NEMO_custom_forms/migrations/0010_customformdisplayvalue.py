@@ -0,0 +1,101 @@
+# Generated by Django 4.2.20 on 2026-10-17 01:00
+
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Copied from the code at the time of this migration, so later changes don't affect it
+def parse_template_data_input(template_data):
+    form_inputs = {}
+    try:
+        template_data_json = json.loads(template_data) if template_data else {}
+        for field_name, data in template_data_json.items():
+            if "user_input" in data:
+                if data["type"] != "group":
+                    form_inputs[field_name] = data["user_input"]
+                else:
+                    form_inputs[field_name] = list(data["user_input"].values())
+    except Exception:
+        pass
+    data_input = {}
+    for question_name, value in form_inputs.items():
+        if isinstance(value, str):
+            data_input[question_name] = value
+        else:
+            for i, input_values in enumerate(value, 1):
+                if isinstance(input_values, str) and len(value) == 1:
+                    data_input[question_name] = input_values
+                elif isinstance(input_values, dict):
+                    for name, input_value in input_values.items():
+                        data_input[f"{name}{i}"] = input_value
+    return data_input
+
+
+def format_display_value(value):
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+def normalize_display_value(value):
+    return " ".join(format_display_value(value).split()).casefold()[:255]
+
+
+def set_display_values(apps, schema_editor):
+    CustomForm = apps.get_model("NEMO_custom_forms", "CustomForm")
+    CustomFormDisplayColumn = apps.get_model("NEMO_custom_forms", "CustomFormDisplayColumn")
+    CustomFormDisplayValue = apps.get_model("NEMO_custom_forms", "CustomFormDisplayValue")
+    template_field_names = {}
+    for column in CustomFormDisplayColumn.objects.all():
+        template_field_names.setdefault(column.template_id, set()).add(column.field_name)
+    display_values = []
+    custom_forms = CustomForm.objects.filter(template_id__in=template_field_names.keys())
+    for custom_form in custom_forms.only("id", "template_id", "template_data").iterator(chunk_size=1000):
+        data_input = parse_template_data_input(custom_form.template_data)
+        for field_name in template_field_names[custom_form.template_id]:
+            if data_input.get(field_name) is not None:
+                display_values.append(
+                    CustomFormDisplayValue(
+                        custom_form_id=custom_form.id,
+                        field_name=field_name,
+                        value=format_display_value(data_input[field_name]),
+                        normalized_value=normalize_display_value(data_input[field_name]),
+                    )
+                )
+        if len(display_values) >= 1000:
+            CustomFormDisplayValue.objects.bulk_create(display_values)
+            display_values = []
+    CustomFormDisplayValue.objects.bulk_create(display_values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO_custom_forms", "0009_custom_form_list_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CustomFormDisplayValue",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("field_name", models.CharField(max_length=255)),
+                ("value", models.TextField(blank=True, null=True)),
+                (
+                    "normalized_value",
+                    models.CharField(help_text="The value used to filter and sort forms.", max_length=255),
+                ),
+                (
+                    "custom_form",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="NEMO_custom_forms.customform"),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["field_name", "normalized_value"], name="customformvalue_normalized")],
+                "unique_together": {("custom_form", "field_name")},
+            },
+        ),
+        migrations.RunPython(set_display_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.20 on 2026-10-17 01:25
+
+import re
+
+import django.db.models.deletion
+from NEMO.utilities import quiet_int
+from django.db import migrations, models
+
+# Copied from the code at the time of this migration, so later changes don't affect it
+CUSTOM_FORM_CURRENT_NUMBER_PREFIX = "custom_form_current_number"
+CUSTOM_FORM_TEMPLATE_PREFIX = "t#"
+
+
+def move_current_numbers_to_sequences(apps, schema_editor):
+    Customization = apps.get_model("NEMO", "Customization")
+    CustomFormPDFTemplate = apps.get_model("NEMO_custom_forms", "CustomFormPDFTemplate")
+    CustomFormNumberSequence = apps.get_model("NEMO_custom_forms", "CustomFormNumberSequence")
+    template_ids = set(CustomFormPDFTemplate.objects.values_list("id", flat=True))
+    template_regex = re.compile(f"^{CUSTOM_FORM_CURRENT_NUMBER_PREFIX}_{CUSTOM_FORM_TEMPLATE_PREFIX}(\\d+)")
+    current_numbers = Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX)
+    for customization in current_numbers:
+        match = template_regex.match(customization.name)
+        if match and int(match.group(1)) in template_ids:
+            CustomFormNumberSequence.objects.update_or_create(
+                name=customization.name,
+                defaults={"template_id": int(match.group(1)), "current_number": quiet_int(customization.value, 0)},
+            )
+    current_numbers.delete()
+
+
+def move_sequences_to_current_numbers(apps, schema_editor):
+    Customization = apps.get_model("NEMO", "Customization")
+    CustomFormNumberSequence = apps.get_model("NEMO_custom_forms", "CustomFormNumberSequence")
+    for sequence in CustomFormNumberSequence.objects.all():
+        Customization.objects.update_or_create(name=sequence.name, defaults={"value": str(sequence.current_number)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO", "0001_version_1_0_0"),
+        ("NEMO_custom_forms", "0010_customformdisplayvalue"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CustomFormNumberSequence",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("current_number", models.PositiveIntegerField(default=0)),
+                (
+                    "template",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="NEMO_custom_forms.customformpdftemplate"
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+        migrations.RunPython(move_current_numbers_to_sequences, move_sequences_to_current_numbers),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.20 on 2026-10-17 02:10
+
+from django.db import migrations
+
+
+def reset_pdf_form_catalogs(apps, schema_editor):
+    # Catalog fields are now an ordered list, templates get their catalog extracted again the first time it's needed
+    CustomFormPDFTemplate = apps.get_model("NEMO_custom_forms", "CustomFormPDFTemplate")
+    CustomFormPDFTemplate.objects.update(pdf_form_catalog=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("NEMO_custom_forms", "0011_customformnumbersequence"),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_pdf_form_catalogs, migrations.RunPython.noop),
+    ]
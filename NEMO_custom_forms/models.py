@@ -3,8 +3,9 @@ from __future__ import annotations
 import json
 import os
 import re
+from logging import getLogger
 from math import floor
-from typing import KeysView, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from NEMO.constants import CHAR_FIELD_LARGE_LENGTH, CHAR_FIELD_MEDIUM_LENGTH, CHAR_FIELD_SMALL_LENGTH
 from NEMO.fields import (
@@ -14,12 +15,11 @@ from NEMO.fields import (
     MultiRoleGroupPermissionChoiceField,
     RoleGroupPermissionChoiceField,
 )
-from NEMO.models import BaseCategory, BaseDocumentModel, BaseModel, Customization, SerializationByNameModel, User
+from NEMO.models import BaseCategory, BaseDocumentModel, BaseModel, SerializationByNameModel, User
 from NEMO.typing import QuerySetType
 from NEMO.utilities import (
     document_filename_upload,
     format_datetime,
-    quiet_int,
     update_media_file_on_model_update,
 )
 from NEMO.views.constants import MEDIA_PROTECTED
@@ -27,7 +27,6 @@ from NEMO.views.notifications import delete_notification
 from NEMO.widgets.dynamic_form import (
     DynamicForm,
     PostUsageGroupQuestion,
-    get_submitted_user_inputs,
     validate_dynamic_form_model,
 )
 from django.contrib.auth.models import Group, Permission
@@ -41,17 +40,28 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
 from NEMO_custom_forms.pdf_utils import (
+    clear_pdf_template_cache,
     copy_and_fill_pdf_form,
+    extract_pdf_form_metadata,
+    get_catalog_field,
+    get_catalog_field_names,
     get_pdf_form_field_names,
     get_pdf_form_field_states_for_field,
+    get_pdf_form_metadata,
     validate_pdf_form,
 )
+from NEMO_custom_forms.rendering import delete_cached_rendered_pdfs, schedule_custom_form_pdf_prerender
 from NEMO_custom_forms.utilities import (
     CUSTOM_FORM_CURRENT_NUMBER_PREFIX,
     CUSTOM_FORM_GROUP_PREFIX,
     CUSTOM_FORM_NOTIFICATION,
     CUSTOM_FORM_TEMPLATE_PREFIX,
     CUSTOM_FORM_USER_PREFIX,
+    format_display_value,
+    invalidate_template_permissions_cache,
+    normalize_display_value,
+    parse_template_data_input,
+    template_permissions_cache_timeout,
 )
 
 re_ends_with_number = r"\d+$"
@@ -76,6 +86,12 @@ class CustomFormPDFTemplate(SerializationByNameModel):
         upload_to=document_filename_upload, validators=[validate_pdf_form], help_text=_("The pdf form")
     )
     form_fields = models.TextField(help_text=_("JSON formatted fields list"))
+    pdf_form_catalog = models.JSONField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=_("The pdf form fields and widgets, extracted when the pdf form is uploaded"),
+    )
     notes_placeholder = models.CharField(
         max_length=CHAR_FIELD_MEDIUM_LENGTH,
         default="Provide additional details if needed",
@@ -98,11 +114,52 @@ class CustomFormPDFTemplate(SerializationByNameModel):
 
         return f"{MEDIA_PROTECTED}/custom_forms/templates/{slugify(self.name)}.pdf"
 
-    def pdf_form_fields(self) -> KeysView[str]:
-        return get_pdf_form_field_names(self.form.file)
+    def pdf_form_fields(self) -> List[str]:
+        catalog = self.get_pdf_form_catalog()
+        if catalog is not None:
+            return get_catalog_field_names(catalog)
+        return get_pdf_form_field_names(self.form.file, self.pdf_form_cache_key())
 
     def pdf_form_field_states(self, field_name: str) -> List[str]:
-        return get_pdf_form_field_states_for_field(self.form.file, field_name)
+        catalog = self.get_pdf_form_catalog()
+        if catalog is not None:
+            field = get_catalog_field(catalog, field_name)
+            return field.get("states") if field else None
+        return get_pdf_form_field_states_for_field(self.form.file, field_name, self.pdf_form_cache_key())
+
+    def get_pdf_form_catalog(self) -> Optional[Dict]:
+        if self.form and not self.form._committed:
+            # New pdf form uploaded but not saved yet (i.e. during admin validation), the stored catalog is outdated
+            return self.get_uploaded_pdf_form_catalog()
+        # Templates uploaded before the catalog existed get it extracted and saved the first time it's needed
+        if self.pdf_form_catalog is None and self.pk and self.form and self.form._committed:
+            try:
+                self.pdf_form_catalog = get_pdf_form_metadata(self.form.file, self.pdf_form_cache_key())
+                CustomFormPDFTemplate.objects.filter(pk=self.pk).update(pdf_form_catalog=self.pdf_form_catalog)
+            except Exception:
+                getLogger(__name__).exception(f"Error extracting the pdf form catalog for template {self.pk}")
+        return self.pdf_form_catalog
+
+    def get_uploaded_pdf_form_catalog(self) -> Optional[Dict]:
+        # The uploaded file is only parsed once, even though it's checked by every special mapping
+        uploaded_file = self.form.file
+        if getattr(self, "_uploaded_pdf_form_catalog", (None, None))[0] is not uploaded_file:
+            try:
+                catalog = extract_pdf_form_metadata(uploaded_file)
+            except Exception:
+                # Invalid forms are caught by the form validator
+                catalog = None
+            self._uploaded_pdf_form_catalog = (uploaded_file, catalog)
+        return self._uploaded_pdf_form_catalog[1]
+
+    def pdf_form_cache_key(self) -> Optional[Tuple]:
+        # Only saved template files are cached, keyed by file name and modification time
+        if self.pk and self.form and self.form._committed:
+            try:
+                return self.pk, self.form.name, self.form.storage.get_modified_time(self.form.name)
+            except (NotImplementedError, OSError):
+                pass
+        return None
 
     def form_fields_json(self) -> List:
         return json.loads(self.form_fields)
@@ -185,6 +242,7 @@ class CustomFormPDFTemplate(SerializationByNameModel):
 @receiver(models.signals.post_delete, sender=CustomFormPDFTemplate)
 def auto_delete_file_on_form_template_delete(sender, instance: CustomFormPDFTemplate, **kwargs):
     """Deletes file from filesystem when corresponding `CustomFormPDFTemplate` object is deleted."""
+    clear_pdf_template_cache(instance.pk)
     if instance.form:
         instance.form.delete(False)
 
@@ -192,6 +250,10 @@ def auto_delete_file_on_form_template_delete(sender, instance: CustomFormPDFTemp
 @receiver(models.signals.pre_save, sender=CustomFormPDFTemplate)
 def auto_update_file_on_form_template_change(sender, instance: CustomFormPDFTemplate, **kwargs):
     """Updates old file from filesystem when corresponding `CustomFormPDFTemplate` object is updated with new file."""
+    clear_pdf_template_cache(instance.pk)
+    if instance.form and not instance.form._committed:
+        # New pdf form uploaded, store its fields catalog
+        instance.pdf_form_catalog = instance.get_uploaded_pdf_form_catalog()
     return update_media_file_on_model_update(instance, "form")
 
 
@@ -246,26 +308,27 @@ class CustomFormAutomaticNumbering(BaseModel):
     def can_generate_custom_form_number(self, user):
         return self.get_role_field().has_user_role(self.role, user)
 
+    def get_sequence_name(self, user: User) -> str:
+        sequence_name = f"{CUSTOM_FORM_CURRENT_NUMBER_PREFIX}_{CUSTOM_FORM_TEMPLATE_PREFIX}{self.template_id}"
+        if self.numbering_group:
+            sequence_name += f"_{CUSTOM_FORM_GROUP_PREFIX}{self.numbering_group}"
+        if self.numbering_per_user:
+            sequence_name += f"_{CUSTOM_FORM_USER_PREFIX}{user.id}"
+        return sequence_name
+
     def next_custom_form_number(self, user: User, save=False) -> Optional[str]:
         if self.enabled and (self.can_generate_custom_form_number(user) or self.generate_automatically()):
-            current_number_customization = (
-                f"{CUSTOM_FORM_CURRENT_NUMBER_PREFIX}_{CUSTOM_FORM_TEMPLATE_PREFIX}{self.template_id}"
-            )
-            if self.numbering_group:
-                current_number_customization += f"_{CUSTOM_FORM_GROUP_PREFIX}{self.numbering_group}"
-            if self.numbering_per_user:
-                current_number_customization += f"_{CUSTOM_FORM_USER_PREFIX}{user.id}"
-            current_number = Customization.objects.filter(name=current_number_customization).first()
-            current_number_value = quiet_int(current_number.value, 0) if current_number else 0
-            current_number_value += 1
+            sequence_name = self.get_sequence_name(user)
+            if save:
+                current_number_value = CustomFormNumberSequence.next_number(self.template_id, sequence_name)
+            else:
+                current_number_value = CustomFormNumberSequence.get_current_number(sequence_name) + 1
             context = {
                 "custom_form_template": self.template,
                 "user": user,
                 "numbering_group": self.numbering_group or "",
                 "current_number": current_number_value,
             }
-            if save:
-                Customization(name=current_number_customization, value=current_number_value).save()
             form_number = Template(self.numbering_template).render(Context(context))
             return form_number
 
@@ -283,6 +346,39 @@ class CustomFormAutomaticNumbering(BaseModel):
         ordering = ["template__name"]
 
 
+class CustomFormNumberSequence(BaseModel):
+    """
+    The current number of an automatic numbering sequence.
+    There is one sequence per template, numbering group and user (when numbering per user), identified by its name.
+    """
+
+    template = models.ForeignKey(CustomFormPDFTemplate, on_delete=models.CASCADE)
+    name = models.CharField(max_length=CHAR_FIELD_MEDIUM_LENGTH, unique=True)
+    current_number = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get_current_number(cls, name: str) -> int:
+        return cls.objects.filter(name=name).values_list("current_number", flat=True).first() or 0
+
+    @classmethod
+    def next_number(cls, template_id: int, name: str) -> int:
+        """
+        Increments the sequence and returns the new number.
+        The increment is done in the database and the row stays locked until the transaction ends,
+        so concurrent submissions always get different numbers.
+        """
+        sequence = cls.objects.filter(name=name)
+        with transaction.atomic():
+            if not sequence.update(current_number=models.F("current_number") + 1):
+                # First number of this sequence, get_or_create handles another request creating it at the same time
+                cls.objects.get_or_create(name=name, defaults={"template_id": template_id})
+                sequence.update(current_number=models.F("current_number") + 1)
+            return sequence.values_list("current_number", flat=True).get()
+
+    def __str__(self):
+        return f"{self.name}: {self.current_number}"
+
+
 class CustomFormAction(BaseModel):
     class ActionTypes(models.TextChoices):
         APPROVAL = "approval", _("Approval")
@@ -527,6 +623,27 @@ class CustomFormDisplayColumn(BaseModel):
         ordering = ["display_order"]
 
 
+class CustomFormProgress:
+    """
+    The progress of a custom form through its template actions, computed once from the (prefetched) actions and records.
+    Role checks are cached in the given dictionary, which can be shared between forms.
+    """
+
+    def __init__(self, custom_form: CustomForm, role_cache: Dict = None):
+        self.actions: List[CustomFormAction] = custom_form.get_sorted_actions()
+        self.records_by_rank: Dict[int, CustomFormActionRecord] = custom_form.get_action_records_by_rank()
+        self.next_action: Optional[CustomFormAction] = next(
+            (action for action in self.actions if action.rank not in self.records_by_rank), None
+        )
+        self.role_cache = role_cache if role_cache is not None else {}
+
+    def has_role(self, user: User, action: CustomFormAction) -> bool:
+        key = (user.id, action.id)
+        if key not in self.role_cache:
+            self.role_cache[key] = action.get_role_field().has_user_role(action.role, user)
+        return self.role_cache[key]
+
+
 class CustomForm(BaseModel):
     class FormStatus(models.IntegerChoices):
         PENDING = 0, _("Pending")
@@ -560,22 +677,111 @@ class CustomForm(BaseModel):
         User, related_name="custom_forms_cancelled", null=True, blank=True, on_delete=models.SET_NULL
     )
     cancellation_reason = models.CharField(null=True, blank=True, max_length=CHAR_FIELD_MEDIUM_LENGTH)
+    next_action_rank = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text=_("The rank of the next action to take on this form (kept up to date from its action records)."),
+    )
 
     class Meta:
         ordering = ["-last_updated"]
+        indexes = [
+            models.Index(fields=["template", "status", "next_action_rank"], name="customform_next_action_rank"),
+            # Used by the custom forms list (only non-cancelled forms, where the database supports partial indexes)
+            models.Index(
+                fields=["template", "-last_updated"],
+                condition=models.Q(cancelled=False),
+                name="customform_active_by_template",
+            ),
+            models.Index(
+                fields=["template", "creator", "-last_updated"],
+                condition=models.Q(cancelled=False),
+                name="customform_active_by_creator",
+            ),
+            models.Index(
+                fields=["template", "status", "-last_updated"],
+                condition=models.Q(cancelled=False),
+                name="customform_active_by_status",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.template_id and self.next_action_rank is None:
+            self.next_action_rank = self.get_next_action_rank()
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "template_data" in update_fields:
+            self.update_display_values()
 
     @property
     def name(self) -> str:
         return self.form_number or f"{self.get_status_display()} Form {self.id}"
 
+    @classmethod
+    def prepare_progress(cls, custom_forms: Iterable[CustomForm]):
+        """
+        Computes the progress of the given forms (usually a page of the custom forms list) in one pass, so progress bars,
+        next actions and permission checks don't run any more queries. Actions and records should be prefetched.
+        """
+        role_cache = {}
+        for custom_form in custom_forms:
+            custom_form._progress = CustomFormProgress(custom_form, role_cache)
+
+    @property
+    def progress(self) -> CustomFormProgress:
+        # Prepared for a whole page of the custom forms list, otherwise computed from the form's actions and records
+        return getattr(self, "_progress", None) or CustomFormProgress(self)
+
+    def get_sorted_actions(self) -> List[CustomFormAction]:
+        if not self.template_id:
+            return []
+        # This is done on purpose (ordering by rank) so we can leverage prefetch_related in the custom_forms view
+        template = self.template
+        if "customformaction_set" not in getattr(template, "_prefetched_objects_cache", {}):
+            return sorted(template.customformaction_set.all(), key=lambda x: x.rank)
+        # Prefetched actions don't change, so they only need to be sorted once
+        if getattr(template, "_sorted_actions", None) is None:
+            template._sorted_actions = sorted(template.customformaction_set.all(), key=lambda x: x.rank)
+        return template._sorted_actions
+
+    def get_action_records_by_rank(self) -> Dict[int, CustomFormActionRecord]:
+        # Built once and shared by next actions, special mappings, progress bars and exports, until an action is taken
+        if getattr(self, "_action_records_by_rank", None) is None:
+            records_by_rank = {}
+            if self.pk:
+                for action_record in self.customformactionrecord_set.all():
+                    records_by_rank.setdefault(action_record.action_rank, action_record)
+            self._action_records_by_rank = records_by_rank
+        return self._action_records_by_rank
+
     def next_action(self) -> Optional[CustomFormAction]:
-        if self.template_id:
-            # This is done on purpose (ordering by rank) so we can leverage prefetch_related in the custom_forms view
-            actions = self.template.customformaction_set.all()
-            actions = sorted(actions, key=lambda x: x.rank)
-            for action in actions:
-                if not self.get_action_record_for_rank(action.rank):
-                    return action
+        return self.progress.next_action
+
+    def get_next_action_rank(self) -> Optional[int]:
+        # Always queried since action records might have been prefetched before the last action was taken
+        remaining_actions = CustomFormAction.objects.filter(template_id=self.template_id)
+        if self.pk:
+            remaining_actions = remaining_actions.exclude(
+                rank__in=self.customformactionrecord_set.values("action_rank")
+            )
+        return remaining_actions.order_by("rank").values_list("rank", flat=True).first()
+
+    @classmethod
+    def update_next_action_ranks(cls, custom_forms: QuerySetType[CustomForm]):
+        """Updates the next action rank of the given forms in a single query."""
+        custom_forms.update(
+            next_action_rank=models.Subquery(
+                CustomFormAction.objects.filter(template_id=models.OuterRef("template_id"))
+                .exclude(
+                    rank__in=CustomFormActionRecord.objects.filter(
+                        custom_form_id=models.OuterRef(models.OuterRef("pk"))
+                    ).values("action_rank")
+                )
+                .order_by("rank")
+                .values("rank")[:1]
+            )
+        )
 
     def has_more_approval_actions(self) -> bool:
         approval_actions = self.template.customformaction_set.filter(
@@ -588,12 +794,21 @@ class CustomForm(BaseModel):
 
     def get_action_record_for_rank(self, rank: int) -> Optional[CustomFormActionRecord]:
         # This is done on purpose because self.customformactionrecord_set.filter(action_rank=rank) cannot be prefetched
-        for action_record in self.customformactionrecord_set.all():
-            if action_record.action_rank == rank:
-                return action_record
-        return None
+        return self.get_action_records_by_rank().get(rank)
 
     def get_filled_pdf_template(self) -> bytes:
+        field_mappings, signature_mappings, stamp, stamp_color = self.get_pdf_fill_values()
+        return copy_and_fill_pdf_form(
+            self.template.form.file,
+            field_mappings,
+            signature_mappings,
+            stamp,
+            stamp_color,
+            cache_key=self.template.pdf_form_cache_key(),
+            widgets=(self.template.get_pdf_form_catalog() or {}).get("widgets"),
+        )
+
+    def get_pdf_fill_values(self) -> Tuple[Dict, Dict, Optional[str], Optional[str]]:
         # we are splitting regular field mappings and "signature" mappings
         # signature mapping will be stamped with a cursive font instead of regular form filling
         field_mappings = {}
@@ -617,24 +832,27 @@ class CustomForm(BaseModel):
         )
         stamp_color = "gray" if self.status == self.FormStatus.PENDING else None
 
-        return copy_and_fill_pdf_form(self.template.form.file, field_mappings, signature_mappings, stamp, stamp_color)
+        return field_mappings, signature_mappings, stamp, stamp_color
 
-    def get_template_data_input(self):
-        form_inputs = get_submitted_user_inputs(self.template_data)
-        data_input = {}
-        for question_name, value in form_inputs.items():
-            if isinstance(value, str):
-                data_input[question_name] = value
-            else:
-                for i, input_values in enumerate(value, 1):
-                    # special case if it's a list of one string, we set it as if that was just one string
-                    # This is especially useful for checkboxes
-                    if isinstance(input_values, str) and len(value) == 1:
-                        data_input[f"{question_name}"] = input_values
-                    elif isinstance(input_values, dict):
-                        for name, input_value in input_values.items():
-                            data_input[f"{name}{i}"] = input_value
-        return data_input
+    def get_template_data_input(self) -> Dict:
+        # Parsed once per template_data value, since it's called for every column of the custom forms list
+        template_data_input = getattr(self, "_template_data_input", None)
+        if template_data_input is None or template_data_input[0] is not self.template_data:
+            template_data_input = (self.template_data, parse_template_data_input(self.template_data))
+            self._template_data_input = template_data_input
+        return template_data_input[1]
+
+    def get_display_values(self) -> Dict:
+        # Uses the display values stored for the template's display columns (usually prefetched)
+        return {
+            display_value.field_name: display_value.value for display_value in self.customformdisplayvalue_set.all()
+        }
+
+    def update_display_values(self, field_names: List[str] = None):
+        if field_names is None:
+            field_names = self.template.customformdisplaycolumn_set.values_list("field_name", flat=True)
+        CustomFormDisplayValue.objects.filter(custom_form=self).delete()
+        CustomFormDisplayValue.objects.bulk_create(CustomFormDisplayValue.for_custom_form(self, field_names))
 
     def process_action(self, user: User, action: CustomFormAction, action_value: str) -> CustomFormActionRecord:
         # double check user is allowed
@@ -649,19 +867,24 @@ class CustomForm(BaseModel):
         action_record.action_result = action_value == "true" if action_value else None
         action_record.full_clean()
         action_record.save()
+        # Actions and records will need to be looked at again
+        self._progress = None
+        self._action_records_by_rank = None
+        getattr(self, "_prefetched_objects_cache", {}).pop("customformactionrecord_set", None)
+        # The next action rank was updated by the action record's post_save receiver
+        self.refresh_from_db(fields=["next_action_rank"])
         # Denied, update status
         if not action_record.action_result:
             self.status = self.FormStatus.DENIED
-            self.save(update_fields=["status"])
         else:
             # No more actions needed, mark as CLOSED
-            if not self.next_action():
+            if self.next_action_rank is None:
                 self.status = self.FormStatus.CLOSED
-                self.save(update_fields=["status"])
             # No more approval actions available, mark as APPROVED
             elif not self.has_more_approval_actions():
                 self.status = self.FormStatus.APPROVED
-                self.save(update_fields=["status"])
+        self.save(update_fields=["status"])
+        schedule_custom_form_pdf_prerender(self)
         return action_record
 
     @transaction.atomic
@@ -682,7 +905,7 @@ class CustomForm(BaseModel):
             return False
         if user == self.creator and not action.self_action_allowed:
             return False
-        return action.get_role_field().has_user_role(action.role, user)
+        return self.progress.has_role(user, action)
 
     def can_take_next_action(self, user: User) -> bool:
         return self.can_take_action(user, self.next_action())
@@ -696,7 +919,7 @@ class CustomForm(BaseModel):
     def can_edit(self, user: User) -> bool:
         if self.cancelled or self.status in self.FormStatus.finished():
             return False
-        creator_and_no_actions_taken_yet = self.creator == user and not self.customformactionrecord_set.exists()
+        creator_and_no_actions_taken_yet = self.creator == user and not self.get_action_records_by_rank()
         return creator_and_no_actions_taken_yet or self.can_take_next_action_and_edit(user)
 
     def next_action_candidates(self) -> QuerySetType[User]:
@@ -718,12 +941,11 @@ class CustomForm(BaseModel):
             color = "success" if self.status == self.FormStatus.CLOSED else "danger"
             result += f'<div class="progress-bar progress-bar-{color}" role="progressbar" aria-valuenow="1" aria-valuemin="0" aria-valuemax="1" style="width: 100%;">{self.get_status_display()}</div>'
         else:
-            # This is done on purpose (ordering by rank) so we can leverage prefetch_related in the custom_forms view
-            actions = self.template.customformaction_set.all()
-            actions = sorted(actions, key=lambda x: x.rank)
+            progress = self.progress
+            actions = progress.actions
             number_of_actions = len(actions)
-            number_of_actions_recorded = self.customformactionrecord_set.count()
-            next_action = self.next_action()
+            number_of_actions_recorded = len(progress.records_by_rank)
+            next_action = progress.next_action
             for index, template_action in enumerate(actions):
                 progress_width = floor(100 / number_of_actions)
                 if index == number_of_actions - 1:
@@ -792,6 +1014,7 @@ class CustomFormActionRecord(BaseModel):
     class Meta:
         ordering = ["-action_time"]
         unique_together = ("custom_form", "action_type", "action_rank")
+        indexes = [models.Index(fields=["custom_form", "action_rank"], name="customformrecord_form_rank")]
 
     def clean(self):
         if self.custom_form_id:
@@ -809,3 +1032,118 @@ class CustomFormActionRecord(BaseModel):
     @property
     def label(self):
         return f"{self.action_name or self.get_action_type_display()}"
+
+
+class CustomFormDisplayValue(BaseModel):
+    """
+    The value of one of the template's display columns for a custom form, kept up to date when the form is saved.
+    This allows the custom forms list to filter and sort on display columns without parsing every form's data.
+    """
+
+    custom_form = models.ForeignKey(CustomForm, on_delete=models.CASCADE)
+    field_name = models.CharField(max_length=CHAR_FIELD_MEDIUM_LENGTH)
+    value = models.TextField(null=True, blank=True)
+    normalized_value = models.CharField(
+        max_length=CHAR_FIELD_MEDIUM_LENGTH, help_text=_("The value used to filter and sort forms.")
+    )
+
+    class Meta:
+        unique_together = ("custom_form", "field_name")
+        indexes = [models.Index(fields=["field_name", "normalized_value"], name="customformvalue_normalized")]
+
+    @classmethod
+    def for_custom_form(cls, custom_form: CustomForm, field_names: Iterable[str]) -> List[CustomFormDisplayValue]:
+        field_names = set(field_names)
+        if not field_names:
+            return []
+        data_input = custom_form.get_template_data_input()
+        return [
+            cls(
+                custom_form=custom_form,
+                field_name=field_name,
+                value=format_display_value(data_input[field_name]),
+                normalized_value=normalize_display_value(data_input[field_name]),
+            )
+            for field_name in field_names
+            if data_input.get(field_name) is not None
+        ]
+
+    @classmethod
+    def rebuild(cls, custom_forms: QuerySetType[CustomForm], batch_size: int = 1000):
+        """Recreates the display values of the given forms, for example after a template's display columns changed."""
+        template_field_names = {}
+        with transaction.atomic():
+            cls.objects.filter(custom_form__in=custom_forms).delete()
+            display_values = []
+            for custom_form in custom_forms.only("id", "template_id", "template_data").iterator(chunk_size=batch_size):
+                if custom_form.template_id not in template_field_names:
+                    template_field_names[custom_form.template_id] = list(
+                        CustomFormDisplayColumn.objects.filter(template_id=custom_form.template_id).values_list(
+                            "field_name", flat=True
+                        )
+                    )
+                display_values.extend(cls.for_custom_form(custom_form, template_field_names[custom_form.template_id]))
+                if len(display_values) >= batch_size:
+                    cls.objects.bulk_create(display_values)
+                    display_values = []
+            cls.objects.bulk_create(display_values)
+
+
+@receiver(models.signals.post_save, sender=CustomFormPDFTemplate)
+@receiver(models.signals.post_delete, sender=CustomFormPDFTemplate)
+@receiver(models.signals.post_save, sender=CustomFormAction)
+@receiver(models.signals.post_delete, sender=CustomFormAction)
+@receiver(models.signals.post_delete, sender=Group)
+@receiver(models.signals.m2m_changed, sender=Group.permissions.through)
+def invalidate_all_template_permissions(sender, **kwargs):
+    """Template or action roles (or what a group allows) changed, invalidate every user's template permissions."""
+    if not template_permissions_cache_timeout():
+        return
+    invalidate_template_permissions_cache()
+
+
+@receiver(models.signals.post_save, sender=User)
+def invalidate_user_template_permissions(sender, instance: User, **kwargs):
+    if not template_permissions_cache_timeout():
+        return
+    invalidate_template_permissions_cache([instance.id])
+
+
+@receiver(models.signals.m2m_changed, sender=User.groups.through)
+@receiver(models.signals.m2m_changed, sender=User.user_permissions.through)
+def invalidate_user_template_permissions_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if not template_permissions_cache_timeout() or not action.startswith("post_"):
+        return
+    if not reverse:
+        # Changed from the user side (user.groups)
+        invalidate_template_permissions_cache([instance.id])
+    elif pk_set is not None:
+        # Changed from the group or permission side (group.user_set)
+        invalidate_template_permissions_cache(pk_set)
+    else:
+        # Cleared from the group or permission side, we don't know which users were affected
+        invalidate_template_permissions_cache()
+
+
+@receiver(models.signals.post_delete, sender=CustomForm)
+def auto_delete_rendered_pdfs_on_custom_form_delete(sender, instance: CustomForm, **kwargs):
+    """Deletes the cached rendered pdfs (which contain the form data) when the corresponding `CustomForm` is deleted."""
+    delete_cached_rendered_pdfs(instance)
+
+
+@receiver(models.signals.post_save, sender=CustomFormAction)
+@receiver(models.signals.post_delete, sender=CustomFormAction)
+def update_template_next_action_ranks(sender, instance: CustomFormAction, **kwargs):
+    CustomForm.update_next_action_ranks(CustomForm.objects.filter(template_id=instance.template_id))
+
+
+@receiver(models.signals.post_save, sender=CustomFormActionRecord)
+@receiver(models.signals.post_delete, sender=CustomFormActionRecord)
+def update_custom_form_next_action_rank(sender, instance: CustomFormActionRecord, **kwargs):
+    CustomForm.update_next_action_ranks(CustomForm.objects.filter(pk=instance.custom_form_id))
+
+
+@receiver(models.signals.post_save, sender=CustomFormDisplayColumn)
+@receiver(models.signals.post_delete, sender=CustomFormDisplayColumn)
+def rebuild_template_display_values(sender, instance: CustomFormDisplayColumn, **kwargs):
+    CustomFormDisplayValue.rebuild(CustomForm.objects.filter(template_id=instance.template_id))
@@ -1,7 +1,9 @@
 from datetime import timedelta
+from typing import Dict
 
 from NEMO.models import Notification
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, OuterRef, Subquery
 from django.utils import timezone
 
 from NEMO_custom_forms.models import CustomForm
@@ -23,3 +25,16 @@ def create_custom_form_notification(custom_form: CustomForm):
                 object_id=custom_form.id,
                 defaults={"expiration": expiration},
             )
+
+
+def get_custom_form_notification_counts(user) -> Dict[int, int]:
+    """Returns the number of custom form notifications the user has for each template id, in a single query"""
+    template_counts = (
+        Notification.objects.filter(notification_type=CUSTOM_FORM_NOTIFICATION, user=user)
+        .annotate(template_id=Subquery(CustomForm.objects.filter(pk=OuterRef("object_id")).values("template_id")[:1]))
+        .filter(template_id__isnull=False)
+        .values("template_id")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    return {template_count["template_id"]: template_count["count"] for template_count in template_counts}
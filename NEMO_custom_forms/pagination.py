@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import base64
+import json
+from collections.abc import Sequence
+from typing import List, Optional, Tuple
+
+from NEMO.utilities import quiet_int
+from NEMO.views.pagination import SortedPaginator
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+KEYSET_ORDER_BY = "-last_updated"
+
+
+def keyset_pagination_enabled() -> bool:
+    return bool(getattr(settings, "CUSTOM_FORMS_KEYSET_PAGINATION", False))
+
+
+def estimated_count_enabled() -> bool:
+    return bool(getattr(settings, "CUSTOM_FORMS_ESTIMATED_COUNT", False))
+
+
+def estimated_count_limit() -> int:
+    return quiet_int(getattr(settings, "CUSTOM_FORMS_ESTIMATED_COUNT_LIMIT", 1000), 1000)
+
+
+def planner_count_estimates(queryset: QuerySet) -> bool:
+    return connections[queryset.db].vendor == "postgresql"
+
+
+def estimated_queryset_count(queryset: QuerySet) -> int:
+    """
+    Returns an estimate of the number of rows in the queryset without counting all of them.
+    On PostgreSQL the query planner estimate is used, other databases count up to CUSTOM_FORMS_ESTIMATED_COUNT_LIMIT rows.
+    """
+    queryset = queryset.order_by()
+    if planner_count_estimates(queryset):
+        plan = json.loads(queryset.explain(format="json"))
+        return int((plan[0] if isinstance(plan, list) else plan)["Plan"]["Plan Rows"])
+    return queryset[: estimated_count_limit()].count()
+
+
+def encode_cursor(custom_form) -> str:
+    value = f"{custom_form.last_updated.isoformat()}|{custom_form.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple]:
+    # Invalid cursors are ignored and the first page is shown instead, like invalid page numbers
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        last_updated, custom_form_id = value.rsplit("|", 1)
+        last_updated = parse_datetime(last_updated)
+        return (last_updated, int(custom_form_id)) if last_updated else None
+    except ValueError:
+        return None
+
+
+class CustomFormsPaginator(SortedPaginator):
+    def get_session_per_page(self, request, query_set, default_per_page: str | None = None) -> str:
+        # Same as SortedPaginator, without evaluating the whole (unpaginated) queryset to check it's not empty
+        per_page_requested = request.GET.get("pp")
+        if request and isinstance(query_set, QuerySet):
+            per_page_name = f"{query_set.model._meta.model_name}_per_page"
+            if per_page_requested:
+                request.session[per_page_name] = per_page_requested
+            if not default_per_page:
+                default_per_page = request.session.get(per_page_name)
+        return per_page_requested or default_per_page or "25"
+
+
+class KeysetPage(Sequence):
+    def __init__(self, object_list: List, paginator: KeysetPaginator, has_next: bool, has_previous: bool):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+        # Page numbers are unknown when paginating with cursors
+        self.number = ""
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def first_query_string(self) -> str:
+        return self.paginator.query_string()
+
+    def next_query_string(self) -> str:
+        return self.paginator.query_string(after=encode_cursor(self.object_list[-1])) if self.object_list else ""
+
+    def previous_query_string(self) -> str:
+        return self.paginator.query_string(before=encode_cursor(self.object_list[0])) if self.object_list else ""
+
+
+class KeysetPaginator(CustomFormsPaginator):
+    """
+    Paginates custom forms on (last_updated, id) using cursors instead of offsets, so any page costs the same as the first one.
+    The "after" and "before" parameters hold the cursor of the last/first form of the page the user navigated from.
+    """
+
+    keyset = True
+
+    def __init__(self, object_list: QuerySet, request, per_page=None, estimated_count=False):
+        self.request = request
+        self.estimated_count = estimated_count
+        super().__init__(object_list, request, per_page)
+        self.object_list = self.object_list.order_by("-last_updated", "-id")
+        self.order_by = KEYSET_ORDER_BY
+
+    @cached_property
+    def count(self):
+        if self.estimated_count:
+            return estimated_queryset_count(self.object_list)
+        return super().count
+
+    @cached_property
+    def count_display(self) -> str:
+        if not self.estimated_count:
+            return str(self.count)
+        if planner_count_estimates(self.object_list):
+            return f"About {self.count}"
+        # Counted up to the limit, so the count is exact unless the limit was reached
+        return f"{self.count}+" if self.count >= estimated_count_limit() else str(self.count)
+
+    def query_string(self, **cursor) -> str:
+        params = self.request.GET.copy()
+        for key in ["p", "after", "before"]:
+            params.pop(key, None)
+        params.update(cursor)
+        return params.urlencode()
+
+    def get_current_page(self) -> KeysetPage:
+        per_page = max(1, quiet_int(self.per_page, 25))
+        after = decode_cursor(self.request.GET.get("after", ""))
+        before = decode_cursor(self.request.GET.get("before", "")) if not after else None
+        if before:
+            last_updated, custom_form_id = before
+            queryset = self.object_list.filter(
+                Q(last_updated__gt=last_updated) | Q(last_updated=last_updated, id__gt=custom_form_id)
+            ).order_by("last_updated", "id")
+            object_list = list(queryset[: per_page + 1])
+            if len(object_list) > per_page:
+                return KeysetPage(list(reversed(object_list[:per_page])), self, True, True)
+            # We are back to the beginning, show a full first page
+        queryset = self.object_list
+        if after:
+            last_updated, custom_form_id = after
+            queryset = queryset.filter(
+                Q(last_updated__lt=last_updated) | Q(last_updated=last_updated, id__lt=custom_form_id)
+            )
+        object_list = list(queryset[: per_page + 1])
+        return KeysetPage(object_list[:per_page], self, len(object_list) > per_page, bool(after))
+
+
+def get_custom_forms_paginator(custom_form_list: QuerySet, request) -> CustomFormsPaginator:
+    # Keyset pagination only supports the default ordering, other orderings use regular page numbers
+    if keyset_pagination_enabled() and request.GET.get("o", KEYSET_ORDER_BY) == KEYSET_ORDER_BY:
+        return KeysetPaginator(custom_form_list, request, estimated_count=estimated_count_enabled())
+    return CustomFormsPaginator(custom_form_list, request, order_by=KEYSET_ORDER_BY)
@@ -1,29 +1,79 @@
 from __future__ import annotations
 
+import hashlib
 import io
+import json
 import math
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+from http.cookiejar import DefaultCookiePolicy
 from io import BytesIO
 from pathlib import Path
-from typing import Dict, IO, KeysView, List, Optional, TYPE_CHECKING, Union
+from tempfile import SpooledTemporaryFile
+from typing import Dict, IO, List, MutableMapping, Optional, TYPE_CHECKING, Tuple, Union
+from weakref import WeakKeyDictionary
 
 import requests
-from PIL import Image, ImageDraw, ImageFont
+from NEMO.utilities import quiet_int
+from NEMO.views.constants import MEDIA_PROTECTED
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 from charset_normalizer.md import getLogger
+from django.conf import settings
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from pypdf import PdfReader, PdfWriter, Transformation
+from pypdf import PageObject, PdfReader, PdfWriter, Transformation
 from pypdf.constants import (
     AnnotationDictionaryAttributes,
     CatalogDictionary,
     FieldDictionaryAttributes,
     InteractiveFormDictEntries,
 )
-from pypdf.generic import NameObject, NumberObject, PdfObject
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    PdfObject,
+)
+from requests.adapters import HTTPAdapter
+
+from NEMO_custom_forms.utilities import LRUCache, evict_storage_folder_files, touch_storage_file
 
 if TYPE_CHECKING:
     from NEMO_custom_forms.models import CustomFormDocuments
 
+# Process-wide cache of PDF templates content and metadata, see get_pdf_form_metadata
+pdf_template_cache = LRUCache("CUSTOM_FORMS_PDF_TEMPLATE_CACHE_SIZE", 20)
+
+# Cache of text rendered as PDF pages (signatures and stamps), see create_text_pdf_page
+text_pdf_page_cache = LRUCache("CUSTOM_FORMS_TEXT_PDF_PAGE_CACHE_SIZE", 256)
+_NOT_CACHED = object()
+
+# Text rendering engines for signatures and stamps
+TEXT_RENDERING_IMAGE = "image"
+TEXT_RENDERING_VECTOR = "vector"
+# Fonts embedded in each writer for the vector rendering engine, see get_writer_pdf_font
+_writer_pdf_fonts: MutableMapping[PdfWriter, Dict] = WeakKeyDictionary()
+PDF_FONT_ENCODING = "cp1252"  # WinAnsiEncoding
+PDF_FONT_UNITS = 1000
+# Number of font sizes above the binary search result that are also checked, see fit_text_in_box
+FIT_TEXT_LOOKAHEAD = 3
+
+# HTTP session shared by URL document downloads, see get_url_document_session
+_url_document_session: Optional[requests.Session] = None
+_url_document_session_lock = threading.Lock()
+URL_DOCUMENT_CACHE_FOLDER = f"{MEDIA_PROTECTED}/custom_forms/url_documents"
+# Default maximum size of the URL document cache (in bytes), use 0 to disable it
+URL_DOCUMENT_CACHE_DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
 
 def validate_pdf_form(file):
     """
@@ -42,28 +92,151 @@ def validate_pdf_form(file):
         raise ValidationError("Could not find any fields in the PDF form.")
 
 
-def get_pdf_form_field_names(stream: Union[Union[str, IO], Path]) -> KeysView[str]:
+def get_pdf_form_field_names(stream: Union[Union[str, IO], Path], cache_key=None) -> List[str]:
     """
     Extracts and retrieves the form field names from a PDF document.
 
     :param stream: A file-like object, string, or Path providing access to the PDF document. The parameter may include
      a file path as a string, an input stream object, or a pathlib.Path object representing the PDF file.
-    :return: A read-only view of the form field names, represented as strings, available in the PDF document.
+    :param cache_key: An optional key used to cache the parsed PDF (see get_pdf_form_metadata).
+    :return: The form field names, represented as strings, available in the PDF document (in the PDF order).
     """
-    return PdfReader(stream).get_fields().keys()
+    return get_catalog_field_names(get_pdf_form_metadata(stream, cache_key))
 
 
-def get_pdf_form_field_states_for_field(stream: Union[Union[str, IO], Path], field_name) -> List[str]:
+def get_pdf_form_field_states_for_field(
+    stream: Union[Union[str, IO], Path], field_name, cache_key=None
+) -> Optional[List[str]]:
     """
     Extracts and returns all possible states for a given form field in a PDF.
 
     :param stream: The input PDF stream to be read. This can be a file path as a string, an IO object, or a Path object.
     :param field_name: The name of the form field for which states will be retrieved.
+    :param cache_key: An optional key used to cache the parsed PDF (see get_pdf_form_metadata).
     :return: A list of strings representing the possible states of the specified form field in the PDF.
     """
-    fields = PdfReader(stream).get_fields()
-    states = fields.get(field_name).get("/_States_")
-    return states
+    field = get_catalog_field(get_pdf_form_metadata(stream, cache_key), field_name)
+    return field.get("states") if field else None
+
+
+def get_pdf_form_metadata(stream: Union[Union[str, IO], Path], cache_key=None) -> Dict:
+    """
+    Returns the form metadata of a PDF document: its fields (with type and possible states) and the widget
+    annotations on each page (with field name, alternate name, type and rect).
+    When a cache key is provided, the result is kept in a process-wide cache so the PDF is only parsed once.
+
+    :param stream: The input PDF stream to be read. This can be a file path as a string, an IO object, or a Path object.
+    :param cache_key: An optional hashable key identifying this version of the PDF. It should be a tuple starting with
+    an identifier of the PDF so previous versions can be cleared with clear_pdf_template_cache.
+    :return: A dictionary with "fields" (a list, in the PDF order) and "widgets" keys.
+    """
+    if cache_key is None:
+        return extract_pdf_form_metadata(stream)
+    cached_template = _get_pdf_template_cache_entry(stream, cache_key)
+    if "metadata" not in cached_template:
+        cached_template["metadata"] = extract_pdf_form_metadata(BytesIO(cached_template["content"]))
+    return cached_template["metadata"]
+
+
+def extract_pdf_form_metadata(stream: Union[Union[str, IO], Path]) -> Dict:
+    reader = PdfReader(stream)
+    # Fields are a list since the catalog is stored as JSON, which doesn't keep the key order on all databases
+    fields = []
+    for field_name, field in (reader.get_fields() or {}).items():
+        states = field.get("/_States_")
+        fields.append(
+            {
+                "name": field_name,
+                "type": str(field.get(FieldDictionaryAttributes.FT) or "") or None,
+                "states": [str(state) for state in states] if states else None,
+            }
+        )
+    widgets = get_widget_annotations(reader.pages)
+    return {"fields": fields, "widgets": widgets}
+
+
+def get_catalog_field_names(catalog: Dict) -> List[str]:
+    return [field["name"] for field in catalog["fields"]]
+
+
+def get_catalog_field(catalog: Dict, field_name: str) -> Optional[Dict]:
+    return next((field for field in catalog["fields"] if field["name"] == field_name), None)
+
+
+def get_widget_annotations(pages) -> List[Dict]:
+    """
+    Returns the widget annotations of all given pages in one pass, with their page index, field name,
+    alternate field name, field type and rect.
+    """
+    widgets = []
+    for page_index, page in enumerate(pages):
+        for annotation in page.annotations or []:
+            annotation_object = annotation.get_object()
+            if annotation_object.get(AnnotationDictionaryAttributes.Subtype) != "/Widget":
+                continue
+            # Widgets of fields with multiple kids get their name and type from the parent
+            parent = annotation_object.get(FieldDictionaryAttributes.Parent)
+            parent = parent.get_object() if parent else {}
+            name = annotation_object.get(FieldDictionaryAttributes.T, parent.get(FieldDictionaryAttributes.T))
+            alternate_name = annotation_object.get(
+                FieldDictionaryAttributes.TU, parent.get(FieldDictionaryAttributes.TU)
+            )
+            field_type = annotation_object.get(FieldDictionaryAttributes.FT, parent.get(FieldDictionaryAttributes.FT))
+            rect = annotation_object.get(AnnotationDictionaryAttributes.Rect)
+            widgets.append(
+                {
+                    "page": page_index,
+                    "name": str(name) if name is not None else None,
+                    "alternate_name": str(alternate_name) if alternate_name is not None else None,
+                    "type": str(field_type) if field_type is not None else None,
+                    "rect": [float(value) for value in rect] if rect else None,
+                }
+            )
+    return widgets
+
+
+def get_widget_index(widgets: List[Dict]) -> Dict[str, List[Dict]]:
+    """Indexes widget annotations (see get_widget_annotations) by field name and alternate field name."""
+    widget_index = defaultdict(list)
+    for widget in widgets:
+        for name in {widget["name"], widget["alternate_name"]}:
+            if name is not None:
+                widget_index[name].append(widget)
+    return widget_index
+
+
+def read_pdf_template(stream: Union[Union[str, IO], Path], cache_key=None) -> bytes:
+    """Returns the content of a PDF, from the process-wide cache if a cache key is provided."""
+    if cache_key is None:
+        return _read_stream(stream)
+    return _get_pdf_template_cache_entry(stream, cache_key)["content"]
+
+
+def clear_pdf_template_cache(identifier=None):
+    """Clears all cached versions of the PDF with the given identifier (first element of its cache key), or all."""
+    if identifier is None:
+        pdf_template_cache.clear()
+    else:
+        pdf_template_cache.delete(*[key for key in pdf_template_cache.keys() if key[0] == identifier])
+
+
+def _get_pdf_template_cache_entry(stream: Union[Union[str, IO], Path], cache_key) -> Dict:
+    # Templates are kept whole, so only the CUSTOM_FORMS_PDF_TEMPLATE_CACHE_SIZE most recently used ones are cached
+    cached_template = pdf_template_cache.get(cache_key)
+    if cached_template is None:
+        cached_template = {"content": _read_stream(stream)}
+        # Only keep the latest version of this PDF
+        clear_pdf_template_cache(cache_key[0])
+        pdf_template_cache.set(cache_key, cached_template)
+    return cached_template
+
+
+def _read_stream(stream: Union[Union[str, IO], Path]) -> bytes:
+    if isinstance(stream, (str, Path)):
+        with open(stream, "rb") as opened_file:
+            return opened_file.read()
+    stream.seek(0)
+    return stream.read()
 
 
 def flatten_pdf(writer: PdfWriter):
@@ -93,42 +266,46 @@ def flatten_pdf(writer: PdfWriter):
                     )
 
 
-def add_signature_mappings_to_pdf(writer: PdfWriter, signature_mappings: Dict):
-    for page in writer.pages:
-        if page.annotations:
-            for field_name, signature_text in signature_mappings.items():
-                if signature_text:
-                    # For each annotation on the page, check for the field name
-                    for annotation in page.annotations:
-                        annotation_object = annotation.get_object()
-                        # Check if the field name matches
-                        if (
-                            annotation_object.get(FieldDictionaryAttributes.T) == field_name
-                            or annotation_object.get(FieldDictionaryAttributes.TU) == field_name
-                        ):
-                            field_rect = annotation_object.get(AnnotationDictionaryAttributes.Rect)
-                            # Scale everything to render the image correctly, then scale back using PDF transform
-                            scale_factor = 5
-                            scaled_field_width = (field_rect[2] - field_rect[0]) * scale_factor
-                            scaled_field_height = (field_rect[3] - field_rect[1]) * scale_factor
-                            field_box = (scaled_field_width, scaled_field_height)
-                            max_font_size = 48 * scale_factor
-                            text_as_image = create_signature_image(signature_text, field_box, max_font_size)
-                            if text_as_image:
-                                signature_pdf_page = convert_image_to_pdf_page(text_as_image)
-                                scaled_sign_width = signature_pdf_page.mediabox[2] - signature_pdf_page.mediabox[0]
-                                scaled_sign_height = signature_pdf_page.mediabox[3] - signature_pdf_page.mediabox[1]
-                                horizontal_start = (scaled_field_width - scaled_sign_width) / 2 / scale_factor
-                                vertical_start = (scaled_field_height - scaled_sign_height) / 2 / scale_factor
-                                page.merge_transformed_page(
-                                    signature_pdf_page,
-                                    Transformation()
-                                    .scale(1 / scale_factor, 1 / scale_factor)
-                                    .translate(
-                                        field_rect[0] + horizontal_start,
-                                        field_rect[1] + vertical_start,
-                                    ),
-                                )
+def add_signature_mappings_to_pdf(writer: PdfWriter, signature_mappings: Dict, widgets: List[Dict] = None):
+    """
+    Stamps each signature text (in a cursive font) on top of the form fields with the matching name or alternate name.
+
+    :param writer: The PDF writer object (`PdfWriter`) to which the signatures will be applied.
+    :param signature_mappings: A dictionary mapping field names to their signature text.
+    :param widgets: Optional list of widget annotations of the PDF (from the template catalog), see
+    get_widget_annotations. It will be extracted from the writer if not provided.
+    """
+    signature_mappings = {field_name: text for field_name, text in signature_mappings.items() if text}
+    if not signature_mappings:
+        return
+    widget_index = get_widget_index(widgets if widgets is not None else get_widget_annotations(writer.pages))
+    for field_name, signature_text in signature_mappings.items():
+        for widget in widget_index.get(field_name, []):
+            field_rect = widget["rect"]
+            if not field_rect:
+                continue
+            page = writer.pages[widget["page"]]
+            # Scale everything to render the image correctly, then scale back using PDF transform
+            scale_factor = 5
+            scaled_field_width = (field_rect[2] - field_rect[0]) * scale_factor
+            scaled_field_height = (field_rect[3] - field_rect[1]) * scale_factor
+            field_box = (scaled_field_width, scaled_field_height)
+            max_font_size = 48 * scale_factor
+            signature_pdf_page = create_signature_pdf_page(signature_text, field_box, max_font_size, writer=writer)
+            if signature_pdf_page:
+                scaled_sign_width = signature_pdf_page.mediabox[2] - signature_pdf_page.mediabox[0]
+                scaled_sign_height = signature_pdf_page.mediabox[3] - signature_pdf_page.mediabox[1]
+                horizontal_start = (scaled_field_width - float(scaled_sign_width)) / 2 / scale_factor
+                vertical_start = (scaled_field_height - float(scaled_sign_height)) / 2 / scale_factor
+                page.merge_transformed_page(
+                    signature_pdf_page,
+                    Transformation()
+                    .scale(1 / scale_factor, 1 / scale_factor)
+                    .translate(
+                        field_rect[0] + horizontal_start,
+                        field_rect[1] + vertical_start,
+                    ),
+                )
 
 
 def add_stamp_to_all_pages(writer: PdfWriter, stamp: Image.Image, stamp_color=None, scale=0.6):
@@ -144,9 +321,12 @@ def add_stamp_to_all_pages(writer: PdfWriter, stamp: Image.Image, stamp_color=No
     :param scale: A float denoting the scaling factor for the stamp, relative to the dimensions
                   of the PDF page. Default is 0.6.
     """
-    if stamp:
-        text_image = create_image_from_text(stamp, within_box=(300, 100), max_font_size=400, color=stamp_color or "red")
-        pdf_stamp = convert_image_to_pdf_page(text_image)
+    pdf_stamp = (
+        create_text_pdf_page(stamp, within_box=(300, 100), max_font_size=400, color=stamp_color or "red", writer=writer)
+        if stamp
+        else None
+    )
+    if pdf_stamp:
         stamp_width = pdf_stamp.mediabox.width
         stamp_height = pdf_stamp.mediabox.height
         for page in writer.pages:
@@ -174,7 +354,7 @@ def add_stamp_to_all_pages(writer: PdfWriter, stamp: Image.Image, stamp_color=No
             )
 
 
-def merge_documents(document_list: List[bytes | CustomFormDocuments]) -> Optional[bytes]:
+def merge_documents(document_list: List[bytes | CustomFormDocuments], output: IO = None) -> Optional[bytes | IO]:
     """
     Merges multiple PDF documents into a single PDF file. The input documents
     can either be in the form of bytes or instances of CustomFormDocuments
@@ -186,43 +366,302 @@ def merge_documents(document_list: List[bytes | CustomFormDocuments]) -> Optiona
                           be either of type bytes or an instance of
                           CustomFormDocuments, which provides the document
                           content through a URL.
-    :return: The merged PDF document as a byte string, or None if the
-             merging process fails completely.
+    :param output: An optional file-like object to write the merged PDF to,
+                   instead of returning it as bytes.
+    :return: The merged PDF document as a byte string (or the output file),
+             or None if the merging process fails completely.
     """
     from NEMO_custom_forms.models import CustomFormDocuments
 
     merger = PdfWriter()
 
-    for document in document_list:
-        try:
-            if isinstance(document, bytes):
-                doc_bytes = document
-            elif (
-                isinstance(document, CustomFormDocuments)
-                and document.document
-                and default_storage.exists(document.document.name)
-            ):
-                with default_storage.open(document.document.name) as opened_file:
-                    doc_bytes = opened_file.read()
-            else:
-                doc_bytes = get_bytes_from_url_document(document.full_link())
-            with BytesIO(doc_bytes) as byte_stream:
-                pdf_file = PdfReader(byte_stream)
+    # URL documents are all downloaded in parallel first
+    url_documents = get_bytes_from_url_documents(
+        [
+            document.full_link()
+            for document in document_list
+            if isinstance(document, CustomFormDocuments) and not is_stored_document(document)
+        ]
+    )
+
+    # Documents in storage are read directly from their file, which has to stay open until the merged PDF is written
+    with ExitStack() as opened_files:
+        for document in document_list:
+            try:
+                if isinstance(document, bytes):
+                    doc_stream = BytesIO(document)
+                elif isinstance(document, CustomFormDocuments) and is_stored_document(document):
+                    doc_stream = opened_files.enter_context(default_storage.open(document.document.name))
+                else:
+                    url_document = url_documents[document.full_link()]
+                    if isinstance(url_document, Exception):
+                        raise url_document
+                    doc_stream = BytesIO(url_document)
+                pdf_file = PdfReader(doc_stream)
                 merger.append(pdf_file)
-        except:
-            getLogger(__name__).exception("Error opening or merging document")
+            except:
+                getLogger(__name__).exception("Error opening or merging document")
+
+        if output is not None:
+            merger.write(output)
+            return output
+        with io.BytesIO() as byte_stream:
+            merger.write(byte_stream)
+            return byte_stream.getvalue()
+
 
-    with io.BytesIO() as byte_stream:
-        merger.write(byte_stream)
-        return byte_stream.getvalue()
+def is_stored_document(document: CustomFormDocuments) -> bool:
+    return bool(document.document) and default_storage.exists(document.document.name)
+
+
+def merge_documents_to_file(document_list: List[bytes | CustomFormDocuments]) -> SpooledTemporaryFile:
+    """
+    Same as merge_documents but writes the merged PDF to a temporary file, kept in memory up to
+    CUSTOM_FORMS_PDF_MERGE_MAX_MEMORY_SIZE bytes (5 MB by default), so large documents end up on disk.
+    The returned file is positioned at the start and should be closed by the caller.
+    """
+    max_memory_size = quiet_int(getattr(settings, "CUSTOM_FORMS_PDF_MERGE_MAX_MEMORY_SIZE", None), 5 * 1024 * 1024)
+    output = SpooledTemporaryFile(max_size=max_memory_size, suffix=".pdf")
+    try:
+        merge_documents(document_list, output)
+        output.seek(0)
+    except BaseException:
+        output.close()
+        raise
+    return output
 
 
 def get_bytes_from_url_document(document_url) -> bytes:
-    response = requests.get(document_url)
+    """
+    Downloads the document using the shared HTTP session. When the server provides an ETag or Last-Modified header,
+    the document is kept in the URL document cache and only downloaded again if it changed (conditional request).
+    """
+    max_cache_size = url_document_cache_max_size()
+    cache_path = url_document_cache_path(document_url) if max_cache_size else None
+    cached_document = get_cached_url_document(cache_path) if cache_path else None
+    headers = {}
+    if cached_document:
+        if cached_document[0].get("etag"):
+            headers["If-None-Match"] = cached_document[0]["etag"]
+        if cached_document[0].get("last_modified"):
+            headers["If-Modified-Since"] = cached_document[0]["last_modified"]
+    response = get_url_document_session().get(document_url, headers=headers, timeout=url_document_timeout())
+    if cached_document and response.status_code == 304:
+        touch_storage_file(cache_path)
+        return cached_document[1]
     response.raise_for_status()
+    validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    if cache_path and any(validators.values()):
+        set_cached_url_document(cache_path, validators, response.content, max_cache_size)
     return response.content
 
 
+def get_bytes_from_url_documents(document_urls: List[str]) -> Dict[str, bytes | Exception]:
+    """
+    Downloads the documents in parallel (up to CUSTOM_FORMS_URL_DOCUMENT_MAX_PARALLEL_DOWNLOADS at a time).
+    Returns the content of each document by URL, or the exception raised when downloading it.
+    """
+    unique_urls = list(dict.fromkeys(document_urls))
+    if not unique_urls:
+        return {}
+    max_workers = quiet_int(getattr(settings, "CUSTOM_FORMS_URL_DOCUMENT_MAX_PARALLEL_DOWNLOADS", None), 4)
+    url_documents = {}
+    with ThreadPoolExecutor(max(1, min(max_workers, len(unique_urls)))) as executor:
+        downloads = {url: executor.submit(get_bytes_from_url_document, url) for url in unique_urls}
+        for url, download in downloads.items():
+            try:
+                url_documents[url] = download.result()
+            except Exception as e:
+                url_documents[url] = e
+    return url_documents
+
+
+def get_url_document_session() -> requests.Session:
+    """Returns the HTTP session shared by all URL document downloads, so connections are pooled and reused."""
+    global _url_document_session
+    with _url_document_session_lock:
+        if _url_document_session is None:
+            pool_size = quiet_int(getattr(settings, "CUSTOM_FORMS_URL_DOCUMENT_POOL_SIZE", None), 10)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            # Documents of different forms (and users) share the session, so cookies set by their hosts are rejected
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _url_document_session = session
+        return _url_document_session
+
+
+def url_document_timeout() -> float:
+    # Timeout in seconds to connect and then to receive data
+    try:
+        return float(getattr(settings, "CUSTOM_FORMS_URL_DOCUMENT_TIMEOUT", 30))
+    except (TypeError, ValueError):
+        return 30
+
+
+def url_document_cache_max_size() -> int:
+    return quiet_int(
+        getattr(settings, "CUSTOM_FORMS_URL_DOCUMENT_CACHE_MAX_SIZE", URL_DOCUMENT_CACHE_DEFAULT_MAX_SIZE), 0
+    )
+
+
+def url_document_cache_path(document_url: str) -> str:
+    return f"{URL_DOCUMENT_CACHE_FOLDER}/{hashlib.sha256(document_url.encode()).hexdigest()}"
+
+
+def get_cached_url_document(cache_path: str) -> Optional[Tuple[Dict, bytes]]:
+    try:
+        if default_storage.exists(f"{cache_path}.json") and default_storage.exists(cache_path):
+            with default_storage.open(f"{cache_path}.json") as validators_file:
+                validators = json.load(validators_file)
+            with default_storage.open(cache_path) as document_file:
+                return validators, document_file.read()
+    except Exception:
+        getLogger(__name__).exception("Error reading URL document from cache")
+    return None
+
+
+def set_cached_url_document(cache_path: str, validators: Dict, content: bytes, max_cache_size: int):
+    try:
+        for file_path in [cache_path, f"{cache_path}.json"]:
+            default_storage.delete(file_path)
+        default_storage.save(cache_path, ContentFile(content))
+        default_storage.save(f"{cache_path}.json", ContentFile(json.dumps(validators).encode()))
+        evict_storage_folder_files(URL_DOCUMENT_CACHE_FOLDER, max_cache_size)
+    except Exception:
+        getLogger(__name__).exception("Error saving URL document to cache")
+
+
+def create_signature_pdf_page(
+    signature_text, within_box=(), max_font_size=None, padding=None, color=None, writer: PdfWriter = None
+) -> Optional[PageObject]:
+    sig_font_path = staticfiles_storage.path("NEMO_custom_forms/fonts/dancing_script.ttf")
+    return create_text_pdf_page(
+        signature_text, within_box, max_font_size, padding, color, font_path=sig_font_path, writer=writer
+    )
+
+
+def get_text_rendering_engine() -> str:
+    return getattr(settings, "CUSTOM_FORMS_TEXT_RENDERING_ENGINE", TEXT_RENDERING_IMAGE)
+
+
+def create_text_pdf_page(
+    text, within_box=(), max_font_size=None, padding=None, color=None, font_path=None, writer: PdfWriter = None
+) -> Optional[PageObject]:
+    """
+    Renders the text as a single PDF page, sized like the image created by create_image_from_text.
+    With the "vector" rendering engine (CUSTOM_FORMS_TEXT_RENDERING_ENGINE setting) and a writer, the text is written
+    as a content stream using the font embedded once in the writer. Otherwise, the text is rendered as an image, and
+    since the same signatures and stamps are rendered over and over, the resulting pages are kept in an LRU cache.
+
+    :param writer: The PDF writer the page will be merged into (required for the vector rendering engine).
+    :return: The PDF page containing the text, or None if the text cannot fit within the specified constraints.
+    """
+    if writer is not None and get_text_rendering_engine() == TEXT_RENDERING_VECTOR:
+        try:
+            return create_vector_text_pdf_page(writer, text, within_box, max_font_size, padding, color, font_path)
+        except UnicodeEncodeError:
+            # Characters not supported by the PDF font encoding, use an image instead
+            pass
+    cache_key = (text, tuple(within_box or ()), font_path, color, max_font_size, tuple(padding or ()))
+    page_bytes = text_pdf_page_cache.get(cache_key, _NOT_CACHED)
+    if page_bytes is _NOT_CACHED:
+        text_image = create_image_from_text(text, within_box, max_font_size, padding, color, font_path)
+        page_bytes = convert_image_to_pdf_bytes(text_image) if text_image else None
+        text_pdf_page_cache.set(cache_key, page_bytes)
+    # Each call gets its own page object since it will be merged into (and modified by) a writer
+    return PdfReader(BytesIO(page_bytes)).pages[0] if page_bytes else None
+
+
+def create_vector_text_pdf_page(
+    writer: PdfWriter, text, within_box=(), max_font_size=None, padding=None, color=None, font_path=None
+) -> Optional[PageObject]:
+    """
+    Creates a PDF page with the text written using the given font embedded in the writer.
+    Raises UnicodeEncodeError if the text contains characters not supported by the font encoding (WinAnsi).
+    """
+    encoded_text = text.encode(PDF_FONT_ENCODING)
+    fitted_text = fit_text_in_box(text, within_box, max_font_size or 48, padding or (0.2, 0.1), font_path)
+    if not fitted_text:
+        return None
+    font_size, (total_width, total_height, padding_horizontal, padding_vertical) = fitted_text
+    ascent, descent = get_font(font_path, font_size).getmetrics()
+    red, green, blue = [value / 255 for value in ImageColor.getrgb(color or "black")[:3]]
+    escaped_text = encoded_text.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+    # Same position as the image text: the top of the text is at -padding_vertical, from the top left corner
+    baseline = total_height + padding_vertical - ascent
+    content = DecodedStreamObject()
+    content.set_data(
+        b"BT /CustomFormsFont %d Tf %.4f %.4f %.4f rg %d %d Td (%s) Tj ET"
+        % (font_size, red, green, blue, padding_horizontal, baseline, escaped_text)
+    )
+    text_page = PageObject.create_blank_page(writer, total_width, total_height)
+    text_page[NameObject("/Resources")] = DictionaryObject(
+        {
+            NameObject("/Font"): DictionaryObject(
+                {NameObject("/CustomFormsFont"): get_writer_pdf_font(writer, font_path)}
+            )
+        }
+    )
+    text_page.replace_contents(content)
+    return text_page
+
+
+def get_writer_pdf_font(writer: PdfWriter, font_path=None) -> IndirectObject:
+    """Returns the TrueType font embedded in the writer, adding it the first time it is used in this writer."""
+    writer_fonts = _writer_pdf_fonts.setdefault(writer, {})
+    if font_path not in writer_fonts:
+        font = get_font(font_path, PDF_FONT_UNITS)
+        font_name = NameObject("/" + "-".join(font.getname()).replace(" ", ""))
+        if font_path:
+            with open(font_path, "rb") as font_file:
+                font_bytes = font_file.read()
+        else:
+            font_bytes = font.font_bytes
+        font_file = DecodedStreamObject()
+        font_file.set_data(font_bytes)
+        font_file = font_file.flate_encode()
+        font_file[NameObject("/Length1")] = NumberObject(len(font_bytes))
+        ascent, descent = font.getmetrics()
+        font_descriptor = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/FontDescriptor"),
+                NameObject("/FontName"): font_name,
+                NameObject("/Flags"): NumberObject(32),  # non-symbolic
+                NameObject("/FontBBox"): ArrayObject(
+                    [NumberObject(0), NumberObject(-descent), NumberObject(PDF_FONT_UNITS), NumberObject(ascent)]
+                ),
+                NameObject("/ItalicAngle"): NumberObject(0),
+                NameObject("/Ascent"): NumberObject(ascent),
+                NameObject("/Descent"): NumberObject(-descent),
+                NameObject("/CapHeight"): NumberObject(ascent),
+                NameObject("/StemV"): NumberObject(80),
+                NameObject("/FontFile2"): writer._add_object(font_file),
+            }
+        )
+        widths = ArrayObject()
+        for code in range(32, 256):
+            try:
+                widths.append(FloatObject(font.getlength(bytes([code]).decode(PDF_FONT_ENCODING))))
+            except UnicodeDecodeError:
+                widths.append(NumberObject(0))
+        pdf_font = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Font"),
+                NameObject("/Subtype"): NameObject("/TrueType"),
+                NameObject("/BaseFont"): font_name,
+                NameObject("/FirstChar"): NumberObject(32),
+                NameObject("/LastChar"): NumberObject(255),
+                NameObject("/Widths"): widths,
+                NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+                NameObject("/FontDescriptor"): writer._add_object(font_descriptor),
+            }
+        )
+        writer_fonts[font_path] = writer._add_object(pdf_font)
+    return writer_fonts[font_path]
+
+
 def create_signature_image(signature_text, within_box=(), max_font_size=None, padding=None, color=None) -> Image.Image:
     sig_font_path = staticfiles_storage.path("NEMO_custom_forms/fonts/dancing_script.ttf")
     return create_image_from_text(signature_text, within_box, max_font_size, padding, color, font_path=sig_font_path)
@@ -247,39 +686,16 @@ def create_image_from_text(
     :return: An image object containing the text, or None if the text cannot fit within the specified constraints.
     """
     # TODO: allow customizing the font in settings.py
-    font_size = max_font_size or 48
-    text_font = ImageFont.truetype(font_path, size=font_size) if font_path else ImageFont.load_default(size=font_size)
+    max_font_size = max_font_size or 48
     color = color or "black"
     padding = padding or (0.2, 0.1)
-    # We need to adjust the text height slightly by 27% of the font size (came up with this value through testing)
-    text_height_adjustment = 0.27
 
-    # Try smaller font size until it fits
-    while True:
-        text_width = text_font.getlength(text)
-        ascent, descent = text_font.getmetrics()
-        text_height = ascent + descent - text_height_adjustment * font_size
-        padding_horizontal = round(padding[0] * font_size)
-        padding_vertical = round(padding[1] * font_size)
-
-        # Add padding around the text
-        total_width = round(text_width) + (2 * padding_horizontal)
-        total_height = round(text_height) + (2 * padding_vertical)
-
-        # Check if text fits within the given box (width, height) if we have a box
-        if not within_box or (total_width <= within_box[0] and total_height <= within_box[1]):
-            break
-
-        # If text doesn't fit, reduce font size
-        font_size -= 1
-        if font_size < 1:  # Prevent infinite loop
-            getLogger(__name__).warning(
-                f"Text: '{text}' cannot fit within the given box, even at the smallest font size, skipping"
-            )
-            return None
-        text_font = (
-            ImageFont.truetype(font_path, size=font_size) if font_path else ImageFont.load_default(size=font_size)
-        )
+    fitted_text = fit_text_in_box(text, within_box, max_font_size, padding, font_path)
+    if not fitted_text:
+        return None
+    font_size, text_size = fitted_text
+    text_font = get_font(font_path, font_size)
+    total_width, total_height, padding_horizontal, padding_vertical = text_size
 
     # Create an image just large enough to fit the text
     text_img = Image.new("RGBA", (total_width, total_height), (255, 255, 255, 0))  # Transparent background
@@ -290,6 +706,67 @@ def create_image_from_text(
     return text_img
 
 
+def fit_text_in_box(
+    text, within_box, max_font_size, padding, font_path=None
+) -> Optional[Tuple[int, Tuple[int, int, int, int]]]:
+    """
+    Finds the largest font size (up to max_font_size) for which the text fits in the box.
+
+    :return: The font size and the text size (see measure_text), or None if the text cannot fit within the box.
+    """
+    # The text size (mostly) grows with the font size, so we can binary search it
+    font_size, text_size = max_font_size, measure_text(text, font_path, max_font_size, padding)
+    if within_box and not text_fits_box(text_size, within_box):
+        font_size, text_size = None, None
+        lowest, highest = 1, max_font_size - 1
+        while lowest <= highest:
+            middle = (lowest + highest) // 2
+            middle_size = measure_text(text, font_path, middle, padding)
+            if text_fits_box(middle_size, within_box):
+                font_size, text_size = middle, middle_size
+                lowest = middle + 1
+            else:
+                highest = middle - 1
+        # Rounding the padding makes the text size slightly non-monotonic, so a few larger sizes may still fit
+        searched_size = font_size or 0
+        for larger in range(searched_size + 1, min(searched_size + FIT_TEXT_LOOKAHEAD, max_font_size - 1) + 1):
+            larger_size = measure_text(text, font_path, larger, padding)
+            if text_fits_box(larger_size, within_box):
+                font_size, text_size = larger, larger_size
+        if font_size is None:
+            getLogger(__name__).warning(
+                f"Text: '{text}' cannot fit within the given box, even at the smallest font size, skipping"
+            )
+            return None
+    return font_size, text_size
+
+
+def measure_text(text, font_path, font_size, padding) -> Tuple[int, int, int, int]:
+    """Returns the image width, height and horizontal/vertical padding needed to render the text at this font size."""
+    text_font = get_font(font_path, font_size)
+    # We need to adjust the text height slightly by 27% of the font size (came up with this value through testing)
+    text_height_adjustment = 0.27
+    text_width = text_font.getlength(text)
+    ascent, descent = text_font.getmetrics()
+    text_height = ascent + descent - text_height_adjustment * font_size
+    padding_horizontal = round(padding[0] * font_size)
+    padding_vertical = round(padding[1] * font_size)
+
+    # Add padding around the text
+    total_width = round(text_width) + (2 * padding_horizontal)
+    total_height = round(text_height) + (2 * padding_vertical)
+    return total_width, total_height, padding_horizontal, padding_vertical
+
+
+def text_fits_box(text_size: Tuple[int, int, int, int], within_box) -> bool:
+    return text_size[0] <= within_box[0] and text_size[1] <= within_box[1]
+
+
+@lru_cache(maxsize=512)
+def get_font(font_path, font_size) -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]:
+    return ImageFont.truetype(font_path, size=font_size) if font_path else ImageFont.load_default(size=font_size)
+
+
 def convert_image_to_pdf_page(image: Image.Image):
     """
     Converts an image into a single-page PDF and extracts that page into a PDF page object.
@@ -297,9 +774,7 @@ def convert_image_to_pdf_page(image: Image.Image):
     :param image: The image object to be converted to a PDF page.
     :return: The extracted single PDF page object created from the input image.
     """
-    img_byte_stream = io.BytesIO()
-    image.save(img_byte_stream, format="PDF")
-    img_byte_stream.seek(0)
+    img_byte_stream = io.BytesIO(convert_image_to_pdf_bytes(image))
 
     tmp_reader = PdfReader(img_byte_stream)
     pdf_page = tmp_reader.pages[0]  # Extract the only page
@@ -307,22 +782,36 @@ def convert_image_to_pdf_page(image: Image.Image):
     return pdf_page
 
 
-def clone_pdf(stream: Union[Union[str, IO], Path]) -> PdfWriter:
+def convert_image_to_pdf_bytes(image: Image.Image) -> bytes:
+    with io.BytesIO() as img_byte_stream:
+        image.save(img_byte_stream, format="PDF")
+        return img_byte_stream.getvalue()
+
+
+def clone_pdf(stream: Union[Union[str, IO], Path], cache_key=None) -> PdfWriter:
     """
     Creates a complete copy of a PDF document from the given input stream or file path.
 
     :param stream: The input source for the PDF to be cloned. Can be provided as a string representing the file path,
     an IO object for binary reading, or a Path object representing the file system path to the target document.
+    :param cache_key: An optional key used to cache the PDF content (see get_pdf_form_metadata).
     :return: A PdfWriter object containing the cloned PDF document.
     """
-    reader = PdfReader(stream)
+    reader = PdfReader(BytesIO(read_pdf_template(stream, cache_key)))
     writer = PdfWriter()
     writer.clone_document_from_reader(reader)
     return writer
 
 
 def copy_and_fill_pdf_form(
-    stream, field_key_values: Dict, signature_mappings: Dict, page_stamp=None, page_stamp_color=None, flatten=True
+    stream,
+    field_key_values: Dict,
+    signature_mappings: Dict,
+    page_stamp=None,
+    page_stamp_color=None,
+    flatten=True,
+    cache_key=None,
+    widgets: List[Dict] = None,
 ) -> bytes:
     """
     Copies and fills a given PDF form with specified field key-value pairs and optional signature mappings. Allows
@@ -335,9 +824,11 @@ def copy_and_fill_pdf_form(
     :param page_stamp: An optional stamp to apply to each page of the PDF. Defaults to None.
     :param page_stamp_color: An optional color for the stamp. Defaults to None (red).
     :param flatten: A boolean indicating whether to flatten the PDF form fields after filling them. Defaults to True.
+    :param cache_key: An optional key used to cache the PDF content (see get_pdf_form_metadata).
+    :param widgets: Optional list of widget annotations of the PDF, used to place signatures.
     :return: A bytes object containing the updated and optionally flattened PDF content.
     """
-    writer = clone_pdf(stream)
+    writer = clone_pdf(stream, cache_key)
 
     for page in writer.pages:
         writer.update_page_form_field_values(page, field_key_values)
@@ -357,7 +848,7 @@ def copy_and_fill_pdf_form(
         flatten_pdf(writer)
 
     if signature_mappings:
-        add_signature_mappings_to_pdf(writer, signature_mappings)
+        add_signature_mappings_to_pdf(writer, signature_mappings, widgets)
 
     if page_stamp:
         add_stamp_to_all_pages(writer, page_stamp, page_stamp_color)
@@ -0,0 +1,437 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from logging import getLogger
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TYPE_CHECKING, Tuple
+from zipfile import ZIP_STORED, ZipFile
+
+import django
+from NEMO.utilities import quiet_int
+from NEMO.views.constants import MEDIA_PROTECTED
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+from NEMO_custom_forms.pdf_utils import copy_and_fill_pdf_form, get_text_rendering_engine, merge_documents_to_file
+from NEMO_custom_forms.utilities import evict_storage_folder_files, list_storage_folder_files, touch_storage_file
+
+if TYPE_CHECKING:
+    from NEMO_custom_forms.models import CustomForm, CustomFormDocuments
+
+RENDERED_PDF_CACHE_FOLDER = f"{MEDIA_PROTECTED}/custom_forms/rendered"
+# Default maximum size of the rendered pdf cache (in bytes), use 0 to disable it
+RENDERED_PDF_CACHE_DEFAULT_MAX_SIZE = 200 * 1024 * 1024
+# The cache is evicted once this fraction of its maximum size was written, see rendered_pdf_cache_needs_eviction
+RENDERED_PDF_CACHE_EVICTION_RATIO = 0.1
+
+# Rendering executors, see get_rendering_executor
+RENDERING_EXECUTOR_INLINE = "inline"
+RENDERING_EXECUTOR_THREAD = "thread"
+RENDERING_EXECUTOR_PROCESS = "process"
+
+logger = getLogger(__name__)
+
+_prerender_executor: Optional[ThreadPoolExecutor] = None
+_prerender_lock = threading.Lock()
+# Ids of forms waiting to be pre-rendered, so quick successive saves only trigger one render
+_prerender_pending: Set[int] = set()
+
+# Bytes written to the rendered pdf cache by this process since it was last evicted
+_rendered_pdf_cache_written = 0
+_rendered_pdf_cache_lock = threading.Lock()
+
+_rendering_executors: Dict[Tuple, RenderingExecutor] = {}
+_rendering_executors_lock = threading.Lock()
+
+
+def rendered_pdf_cache_max_size() -> int:
+    return quiet_int(
+        getattr(settings, "CUSTOM_FORMS_RENDERED_PDF_CACHE_MAX_SIZE", RENDERED_PDF_CACHE_DEFAULT_MAX_SIZE), 0
+    )
+
+
+def get_rendered_custom_form_pdf(custom_form: CustomForm) -> bytes:
+    """
+    Returns the fully rendered pdf (filled template + attached documents) for the given custom form.
+    The result is served from the rendered pdf cache when the form hasn't changed since it was last rendered.
+
+    :param custom_form: The custom form to render.
+    :return: The merged PDF document as a byte string.
+    """
+    with open_rendered_custom_form_pdf(custom_form) as rendered_pdf:
+        return rendered_pdf.read()
+
+
+def open_rendered_custom_form_pdf(custom_form: CustomForm) -> File:
+    """
+    Same as get_rendered_custom_form_pdf but returns a file, opened directly from the rendered pdf cache
+    when the form was already rendered (or pre-rendered), so it can be streamed to the user.
+    """
+    fingerprint, cached_pdf, rendering = start_custom_form_pdf_rendering(custom_form)
+    if cached_pdf is not None:
+        return cached_pdf
+    return finish_custom_form_pdf_rendering(custom_form, fingerprint, rendering)
+
+
+def iter_rendered_custom_form_pdfs(custom_forms: Iterable[CustomForm]) -> Iterator[Tuple[CustomForm, File]]:
+    """
+    Renders the given forms in parallel (using the rendering executor) and yields each form with its pdf file, in order.
+    Each file is closed once the next form is requested.
+    Only a limited number of renders are pending at any time so memory stays bounded, regardless of the number of forms.
+    Forms that fail to render are logged and skipped.
+    """
+    pending = deque()
+    max_pending = get_rendering_executor().queue_limit or 1
+
+    def next_rendered():
+        custom_form, fingerprint, cached_pdf, rendering = pending.popleft()
+        try:
+            if cached_pdf is not None:
+                return custom_form, cached_pdf
+            return custom_form, finish_custom_form_pdf_rendering(custom_form, fingerprint, rendering)
+        except Exception:
+            logger.exception(f"Error rendering pdf for custom form {custom_form.id}")
+
+    def yield_next_rendered():
+        rendered = next_rendered()
+        if rendered:
+            with rendered[1]:
+                yield rendered
+
+    for custom_form in custom_forms:
+        pending.append((custom_form, *start_custom_form_pdf_rendering(custom_form)))
+        if len(pending) >= max_pending:
+            yield from yield_next_rendered()
+    while pending:
+        yield from yield_next_rendered()
+
+
+def stream_custom_form_pdfs_zip(custom_forms: Iterable[CustomForm]) -> Iterator[bytes]:
+    """Generates a zip file containing the rendered pdf of each form, chunk by chunk, as the forms are rendered."""
+    zip_buffer = ZipStreamBuffer()
+    file_names = set()
+    # PDF files are already compressed, so they are stored as is
+    with ZipFile(zip_buffer, "w", compression=ZIP_STORED) as zip_file:
+        for custom_form, pdf_file in iter_rendered_custom_form_pdfs(custom_forms):
+            file_name = f"{custom_form.rendered_filename()}.pdf"
+            if file_name in file_names:
+                file_name = f"{custom_form.rendered_filename()}_{custom_form.id}.pdf"
+            file_names.add(file_name)
+            with zip_file.open(file_name, "w", force_zip64=True) as zip_entry:
+                for chunk in pdf_file.chunks():
+                    zip_entry.write(chunk)
+                    yield zip_buffer.pop()
+            yield zip_buffer.pop()
+    yield zip_buffer.pop()
+
+
+class ZipStreamBuffer:
+    """Minimal non-seekable file, collecting what is written to it until it is popped."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def start_custom_form_pdf_rendering(custom_form: CustomForm) -> Tuple[Optional[str], Optional[File], Optional[Future]]:
+    """Returns the form fingerprint, and either the file from the rendered pdf cache or the submitted rendering."""
+    fill_values = custom_form.get_pdf_fill_values()
+    fingerprint = custom_form_pdf_fingerprint(custom_form, fill_values) if rendered_pdf_cache_max_size() else None
+    if fingerprint:
+        cached_pdf = open_cached_rendered_pdf(custom_form, fingerprint)
+        if cached_pdf is not None:
+            return fingerprint, cached_pdf, None
+    return fingerprint, None, submit_custom_form_pdf_rendering(custom_form, fill_values)
+
+
+def finish_custom_form_pdf_rendering(custom_form: CustomForm, fingerprint: Optional[str], rendering: Future) -> File:
+    rendered_pdf = rendering.result()
+    # Renders done in another process come back as bytes
+    rendered_pdf = ContentFile(rendered_pdf) if isinstance(rendered_pdf, bytes) else File(rendered_pdf)
+    if fingerprint:
+        set_cached_rendered_pdf(custom_form, fingerprint, rendered_pdf)
+        rendered_pdf.seek(0)
+    return rendered_pdf
+
+
+def submit_custom_form_pdf_rendering(custom_form: CustomForm, fill_values: Tuple = None) -> Future:
+    """
+    Collects everything needed to render the form pdf (all the database access happens here, in the calling thread)
+    and submits the actual rendering, which is pure CPU work, to the rendering executor.
+
+    :param custom_form: The custom form to render.
+    :param fill_values: The form pdf fill values, if already computed (see CustomForm.get_pdf_fill_values).
+    :return: A future with the merged PDF document, as a temporary file (or as bytes when rendered in another process).
+    """
+    field_mappings, signature_mappings, stamp, stamp_color = fill_values or custom_form.get_pdf_fill_values()
+    template = custom_form.template
+    rendering_executor = get_rendering_executor()
+    return rendering_executor.submit(
+        render_custom_form_pdf_bytes if rendering_executor.separate_process else render_custom_form_pdf_documents,
+        template.form.name,
+        template.pdf_form_cache_key(),
+        (template.get_pdf_form_catalog() or {}).get("widgets"),
+        field_mappings,
+        signature_mappings,
+        stamp,
+        stamp_color,
+        list(custom_form.customformdocuments_set.all()),
+    )
+
+
+def render_custom_form_pdf_documents(
+    template_file_name: str,
+    cache_key: Optional[Tuple],
+    widgets: Optional[List[Dict]],
+    field_mappings: Dict,
+    signature_mappings: Dict,
+    stamp: Optional[str],
+    stamp_color: Optional[str],
+    documents: List[CustomFormDocuments],
+) -> SpooledTemporaryFile:
+    # Runs in the rendering executor (possibly in another process), so it shouldn't use the database
+    with default_storage.open(template_file_name) as template_file:
+        filled_pdf_template = copy_and_fill_pdf_form(
+            template_file, field_mappings, signature_mappings, stamp, stamp_color, cache_key=cache_key, widgets=widgets
+        )
+    return merge_documents_to_file([filled_pdf_template, *documents])
+
+
+def render_custom_form_pdf_bytes(*args) -> bytes:
+    # Files cannot be sent back from another process
+    with render_custom_form_pdf_documents(*args) as rendered_pdf:
+        return rendered_pdf.read()
+
+
+class InlineExecutor(Executor):
+    """Executor running functions directly in the calling thread."""
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class RenderingExecutor:
+    """Wraps an executor, blocking new submissions while queue_limit renders are already queued or running."""
+
+    def __init__(self, executor: Executor, queue_limit: Optional[int] = None):
+        self.executor = executor
+        self.separate_process = isinstance(executor, ProcessPoolExecutor)
+        self.queue_limit = queue_limit
+        self.slots = threading.BoundedSemaphore(queue_limit) if queue_limit else None
+
+    def submit(self, fn, *args) -> Future:
+        if self.slots is None:
+            return self.executor.submit(fn, *args)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done_future: self.slots.release())
+        return future
+
+
+def get_rendering_executor() -> RenderingExecutor:
+    """
+    Returns the executor used to render pdfs, based on the CUSTOM_FORMS_PDF_RENDERING_EXECUTOR setting:
+    "inline" (default) renders in the calling thread, "thread" in a thread pool, and "process" in a process pool,
+    which keeps the CPU heavy rendering from holding the GIL of the web worker and uses multiple cores.
+    Pools have CUSTOM_FORMS_PDF_RENDERING_WORKERS workers (defaults to the number of CPUs)
+    and accept up to CUSTOM_FORMS_PDF_RENDERING_QUEUE_LIMIT renders at a time (defaults to twice the workers).
+    """
+    executor_type = getattr(settings, "CUSTOM_FORMS_PDF_RENDERING_EXECUTOR", RENDERING_EXECUTOR_INLINE)
+    if executor_type not in [RENDERING_EXECUTOR_THREAD, RENDERING_EXECUTOR_PROCESS]:
+        executor_type = RENDERING_EXECUTOR_INLINE
+    max_workers = max(1, quiet_int(getattr(settings, "CUSTOM_FORMS_PDF_RENDERING_WORKERS", None), os.cpu_count() or 1))
+    queue_limit = max(0, quiet_int(getattr(settings, "CUSTOM_FORMS_PDF_RENDERING_QUEUE_LIMIT", None), max_workers * 2))
+    executor_key = (executor_type, max_workers, queue_limit)
+    with _rendering_executors_lock:
+        if executor_key not in _rendering_executors:
+            if executor_type == RENDERING_EXECUTOR_THREAD:
+                executor = ThreadPoolExecutor(max_workers, thread_name_prefix="custom_forms_rendering")
+            elif executor_type == RENDERING_EXECUTOR_PROCESS:
+                # spawn instead of fork, since the web worker may have other threads running
+                executor = ProcessPoolExecutor(
+                    max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup
+                )
+            else:
+                executor, queue_limit = InlineExecutor(), None
+            _rendering_executors[executor_key] = RenderingExecutor(executor, queue_limit)
+        return _rendering_executors[executor_key]
+
+
+def pdf_prerendering_enabled() -> bool:
+    return bool(getattr(settings, "CUSTOM_FORMS_PDF_PRERENDERING", False)) and bool(rendered_pdf_cache_max_size())
+
+
+def schedule_custom_form_pdf_prerender(custom_form: CustomForm):
+    """
+    When enabled (CUSTOM_FORMS_PDF_PRERENDERING setting), renders the form pdf in the background once the current
+    transaction is committed, so it is ready in the rendered pdf cache by the time someone downloads it.
+    """
+    if not pdf_prerendering_enabled() or not custom_form.pk:
+        return
+    custom_form_id = custom_form.pk
+
+    def submit_prerender():
+        with _prerender_lock:
+            if custom_form_id in _prerender_pending:
+                return
+            _prerender_pending.add(custom_form_id)
+        get_prerender_executor().submit(run_in_worker_thread, prerender_custom_form_pdf, custom_form_id)
+
+    transaction.on_commit(submit_prerender)
+
+
+def get_prerender_executor() -> ThreadPoolExecutor:
+    global _prerender_executor
+    with _prerender_lock:
+        if _prerender_executor is None:
+            max_workers = quiet_int(getattr(settings, "CUSTOM_FORMS_PDF_PRERENDERING_WORKERS", 1), 1)
+            _prerender_executor = ThreadPoolExecutor(max(1, max_workers), thread_name_prefix="custom_forms_prerender")
+        return _prerender_executor
+
+
+def run_in_worker_thread(function, *args):
+    try:
+        return function(*args)
+    finally:
+        # Worker threads get their own database connections, which would otherwise never be closed
+        connections.close_all()
+
+
+def prerender_custom_form_pdf(custom_form_id: int):
+    from NEMO_custom_forms.models import CustomForm
+
+    with _prerender_lock:
+        _prerender_pending.discard(custom_form_id)
+    try:
+        custom_form = CustomForm.objects.filter(pk=custom_form_id, cancelled=False).first()
+        if custom_form:
+            get_rendered_custom_form_pdf(custom_form)
+    except Exception:
+        logger.exception(f"Error pre-rendering pdf for custom form {custom_form_id}")
+
+
+def custom_form_pdf_fingerprint(custom_form: CustomForm, fill_values: Tuple = None) -> Optional[str]:
+    """
+    Computes a fingerprint of everything that goes into the rendered pdf of a custom form: the template file version,
+    the values filled in (dynamic form data, special mappings including action records), the stamp and the documents.
+    Returns None if the form cannot be cached (i.e. it has URL documents, which can change without us knowing).
+    """
+    field_mappings, signature_mappings, stamp, stamp_color = fill_values or custom_form.get_pdf_fill_values()
+    documents = []
+    for document in custom_form.customformdocuments_set.all():
+        if not document.document or not default_storage.exists(document.document.name):
+            return None
+        documents.append([document.id, document.document.name, default_storage.size(document.document.name)])
+    fingerprint = {
+        "template": custom_form.template.pdf_form_cache_key() or file_digest(custom_form.template.form.name),
+        "fields": field_mappings,
+        "signatures": signature_mappings,
+        "stamp": [stamp, stamp_color],
+        "text_rendering": get_text_rendering_engine(),
+        "documents": documents,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(file_name: str) -> str:
+    digest = hashlib.sha256()
+    with default_storage.open(file_name) as opened_file:
+        for chunk in opened_file.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def rendered_pdf_cache_folder(custom_form_id: int) -> str:
+    # Each form has its own folder, so its stale renders can be found without listing the whole cache
+    return f"{RENDERED_PDF_CACHE_FOLDER}/{custom_form_id}"
+
+
+def rendered_pdf_cache_path(custom_form: CustomForm, fingerprint: str) -> str:
+    return f"{rendered_pdf_cache_folder(custom_form.id)}/{fingerprint}.pdf"
+
+
+def open_cached_rendered_pdf(custom_form: CustomForm, fingerprint: str) -> Optional[File]:
+    cache_path = rendered_pdf_cache_path(custom_form, fingerprint)
+    try:
+        if default_storage.exists(cache_path):
+            cached_pdf = default_storage.open(cache_path)
+            touch_storage_file(cache_path)
+            return cached_pdf
+    except Exception:
+        logger.exception("Error reading rendered pdf from cache")
+    return None
+
+
+def set_cached_rendered_pdf(custom_form: CustomForm, fingerprint: str, content: File):
+    cache_path = rendered_pdf_cache_path(custom_form, fingerprint)
+    try:
+        # Previous renders of this form are now stale
+        delete_cached_rendered_pdfs(custom_form)
+        default_storage.save(cache_path, content)
+        max_size = rendered_pdf_cache_max_size()
+        if rendered_pdf_cache_needs_eviction(content.size, max_size):
+            evict_rendered_pdfs(max_size)
+    except Exception:
+        logger.exception("Error saving rendered pdf to cache")
+
+
+def delete_cached_rendered_pdfs(custom_form: CustomForm):
+    form_cache_folder = rendered_pdf_cache_folder(custom_form.id)
+    try:
+        for file_name in list_storage_folder_files(form_cache_folder):
+            default_storage.delete(f"{form_cache_folder}/{file_name}")
+        default_storage.delete(form_cache_folder)
+    except Exception:
+        logger.exception(f"Error deleting rendered pdfs of custom form {custom_form.id} from cache")
+
+
+def list_cached_rendered_pdfs():
+    return list_storage_folder_files(RENDERED_PDF_CACHE_FOLDER, recursive=True)
+
+
+def rendered_pdf_cache_needs_eviction(written_size: int, max_size: int) -> bool:
+    """
+    Evicting lists every file in the cache (a round trip per file on remote storages), so instead of after every render,
+    it is only done once this process has written RENDERED_PDF_CACHE_EVICTION_RATIO of the cache maximum size.
+    The cache can therefore go over its maximum size by that much for each process.
+    """
+    global _rendered_pdf_cache_written
+    with _rendered_pdf_cache_lock:
+        _rendered_pdf_cache_written += written_size
+        if _rendered_pdf_cache_written < max_size * RENDERED_PDF_CACHE_EVICTION_RATIO:
+            return False
+        _rendered_pdf_cache_written = 0
+        return True
+
+
+def evict_rendered_pdfs(max_size: int):
+    """Deletes the least recently used rendered pdfs until the cache is under the given size (in bytes)."""
+    evict_storage_folder_files(RENDERED_PDF_CACHE_FOLDER, max_size, recursive=True)
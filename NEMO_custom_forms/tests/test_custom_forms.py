@@ -1,16 +1,42 @@
-from NEMO.models import Customization
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from NEMO.models import Notification
 from NEMO.tests.test_utilities import create_user_and_project
 from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
 
 from NEMO_custom_forms.models import (
     CustomForm,
     CustomFormAction,
     CustomFormAutomaticNumbering,
+    CustomFormDisplayColumn,
+    CustomFormDisplayValue,
+    CustomFormNumberSequence,
     CustomFormPDFTemplate,
 )
-from NEMO_custom_forms.utilities import CUSTOM_FORM_CURRENT_NUMBER_PREFIX, custom_forms_current_numbers
+from NEMO_custom_forms.notifications import get_custom_form_notification_counts
+from NEMO_custom_forms.views.custom_forms import (
+    CustomFormTemplatePermissions,
+    available_templates_for_user_to_see,
+    get_custom_form_template_permissions,
+)
+from NEMO_custom_forms.utilities import (
+    CUSTOM_FORM_NOTIFICATION,
+    custom_forms_current_numbers,
+)
 
 
 class CustomFormsTest(TestCase):
@@ -100,7 +126,7 @@ class CustomFormsTest(TestCase):
 
     def test_current_custom_form_order_numbers(self):
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         custom_form_template = CustomFormPDFTemplate.objects.create(name="Form 11", id=11)
         custom_form_template_2 = CustomFormPDFTemplate.objects.create(name="Form 12", id=12)
         automatic_numbering: CustomFormAutomaticNumbering = CustomFormAutomaticNumbering.objects.create(
@@ -120,7 +146,7 @@ class CustomFormsTest(TestCase):
         automatic_numbering.next_custom_form_number(self.user, save=True)
         self.assertEqual({None: "1"}, custom_forms_current_numbers(custom_form_template))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         # Case 2: automatic numbering enabled, by user only
         automatic_numbering.enabled = True
         automatic_numbering.numbering_per_user = True
@@ -130,7 +156,7 @@ class CustomFormsTest(TestCase):
         automatic_numbering.next_custom_form_number(self.user, save=True)
         self.assertEqual({str(self.user.id): "1"}, custom_forms_current_numbers(custom_form_template))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         # Case 3: automatic numbering enabled, by group
         automatic_numbering.enabled = True
         automatic_numbering.numbering_per_user = False
@@ -140,7 +166,7 @@ class CustomFormsTest(TestCase):
         automatic_numbering.next_custom_form_number(self.user, save=True)
         self.assertEqual({"24": "1"}, custom_forms_current_numbers(custom_form_template))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         # Case 4: automatic numbering enabled, by group and user
         automatic_numbering.enabled = True
         automatic_numbering.numbering_per_user = True
@@ -150,7 +176,7 @@ class CustomFormsTest(TestCase):
         automatic_numbering.next_custom_form_number(self.user, save=True)
         self.assertEqual({"24": {str(self.user.id): "1"}}, custom_forms_current_numbers(custom_form_template))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         # Case 5: automatic numbering enabled, by group and user with 2 templates
         automatic_numbering.enabled = True
         automatic_numbering.numbering_per_user = True
@@ -168,7 +194,7 @@ class CustomFormsTest(TestCase):
         self.assertEqual({"24": {str(self.user.id): "1"}}, custom_forms_current_numbers(custom_form_template))
         self.assertEqual({"24": {str(self.user.id): "1"}}, custom_forms_current_numbers(custom_form_template_2))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
         # Case 6: automatic numbering enabled, by group and user with different groups
         automatic_numbering.enabled = True
         automatic_numbering.numbering_per_user = True
@@ -185,7 +211,25 @@ class CustomFormsTest(TestCase):
         self.assertEqual({"23": {str(self.user.id): "1"}}, custom_forms_current_numbers(custom_form_template))
         self.assertEqual({"24": {str(self.user.id): "1"}}, custom_forms_current_numbers(custom_form_template_2))
         # reset all custom form settings
-        Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX).delete()
+        CustomFormNumberSequence.objects.all().delete()
+
+    def test_number_sequence_admin(self):
+        custom_form_template = CustomFormPDFTemplate.objects.create(name="Form 13")
+        automatic_numbering = CustomFormAutomaticNumbering.objects.create(
+            template=custom_form_template, numbering_template="{{ current_number }}", role="is_staff"
+        )
+        automatic_numbering.next_custom_form_number(self.user, save=True)
+        sequence = CustomFormNumberSequence.objects.get(template=custom_form_template)
+        self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertContains(
+            self.client.get(reverse("admin:NEMO_custom_forms_customformnumbersequence_changelist")), sequence.name
+        )
+        # Sequences can be reset
+        change_url = reverse("admin:NEMO_custom_forms_customformnumbersequence_change", args=[sequence.id])
+        self.client.post(change_url, {"current_number": 0})
+        self.assertEqual(automatic_numbering.next_custom_form_number(self.user, save=True), "1")
 
     def test_action_role(self):
         custom_form_template = CustomFormPDFTemplate.objects.create(name="Form 11", id=11)
@@ -232,3 +276,426 @@ class CustomFormsTest(TestCase):
         automatic_numbering.full_clean()
         automatic_numbering.save()
         self.assertTrue(automatic_numbering.next_custom_form_number(self.user))
+
+    def test_custom_form_notification_counts(self):
+        template_1 = CustomFormPDFTemplate.objects.create(name="Form 13")
+        template_2 = CustomFormPDFTemplate.objects.create(name="Form 14")
+        other_user, other_project = create_user_and_project()
+        content_type = ContentType.objects.get_for_model(CustomForm)
+        for template, count in [(template_1, 3), (template_2, 1)]:
+            for i in range(count):
+                custom_form = CustomForm.objects.create(template=template, creator=other_user)
+                for user in [self.user, other_user]:
+                    Notification.objects.create(
+                        user=user,
+                        notification_type=CUSTOM_FORM_NOTIFICATION,
+                        content_type=content_type,
+                        object_id=custom_form.id,
+                        expiration=timezone.now() + timedelta(days=1),
+                    )
+        # Notification for a form that doesn't exist anymore
+        Notification.objects.create(
+            user=self.user,
+            notification_type=CUSTOM_FORM_NOTIFICATION,
+            content_type=content_type,
+            object_id=0,
+            expiration=timezone.now() + timedelta(days=1),
+        )
+        with self.assertNumQueries(1):
+            notification_counts = get_custom_form_notification_counts(self.user)
+        self.assertEqual(notification_counts, {template_1.id: 3, template_2.id: 1})
+
+    def test_custom_form_template_permissions(self):
+        group = Group.objects.create(name="Approvers")
+        self.user.groups.add(group)
+        templates = []
+        for i in range(6):
+            template = CustomFormPDFTemplate.objects.create(
+                name=f"Permissions form {i}",
+                create_permissions=["is_staff"] if i % 3 == 0 else [],
+                view_all_permissions=[str(group.id)] if i % 3 == 1 else [],
+            )
+            CustomFormAction.objects.create(template=template, name="Approval", rank=1, role="is_superuser")
+            CustomFormAction.objects.create(
+                template=template, name="Review", rank=2, role=str(group.id) if i == 5 else "is_facility_manager"
+            )
+            templates.append(template)
+        CustomFormPDFTemplate.objects.create(name="Disabled form", enabled=False, create_permissions=["is_staff"])
+        with self.assertNumQueries(4):
+            # templates, actions, and the group role is only checked once (2 queries)
+            permissions = CustomFormTemplatePermissions(self.user)
+        for template in templates:
+            self.assertEqual(permissions.can_create(template), template.can_user_create(self.user))
+            self.assertEqual(permissions.can_view_all(template), template.can_user_view_all(self.user))
+            self.assertEqual(permissions.can_approve(template), template.can_user_approve(self.user))
+        self.assertEqual(
+            permissions.visible_templates(), [templates[0], templates[1], templates[3], templates[4], templates[5]]
+        )
+        self.assertEqual(permissions.creatable_templates(), [templates[0], templates[3]])
+        # Resolved once per user object (i.e. once per request)
+        with self.assertNumQueries(4):
+            self.assertEqual(len(available_templates_for_user_to_see(self.user)), 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(available_templates_for_user_to_see(self.user)), 5)
+            self.assertTrue(get_custom_form_template_permissions(self.user).can_approve(templates[5]))
+
+    @override_settings(CUSTOM_FORMS_PERMISSIONS_CACHE_TIMEOUT=300)
+    def test_custom_form_template_permissions_cache(self):
+        group = Group.objects.create(name="Viewers")
+        template = CustomFormPDFTemplate.objects.create(name="Cached form", view_all_permissions=[str(group.id)])
+        self.assertFalse(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        with self.assertNumQueries(0):
+            self.assertFalse(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        # Group membership changes, from either side
+        self.user.groups.add(group)
+        self.assertTrue(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        group.user_set.remove(self.user)
+        self.assertFalse(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        # Template changes
+        template.view_all_permissions = ["is_staff"]
+        template.save()
+        self.assertTrue(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        # User role changes
+        self.user.is_staff = False
+        self.user.save()
+        self.assertFalse(CustomFormTemplatePermissions(self.user).can_view_all(template))
+        # Action changes
+        self.assertFalse(CustomFormTemplatePermissions(self.user).can_approve(template))
+        CustomFormAction.objects.create(template=template, name="Approval", rank=1, role="is_active")
+        self.assertTrue(CustomFormTemplatePermissions(self.user).can_approve(template))
+        with self.settings(CUSTOM_FORMS_PERMISSIONS_CACHE_TIMEOUT=0):
+            with self.assertNumQueries(2):
+                CustomFormTemplatePermissions(self.user)
+        # The cache is disabled by default
+        with self.settings():
+            del settings.CUSTOM_FORMS_PERMISSIONS_CACHE_TIMEOUT
+            with self.assertNumQueries(2):
+                CustomFormTemplatePermissions(self.user)
+            # Changes don't touch the cache when it's disabled
+            with mock.patch("NEMO_custom_forms.models.invalidate_template_permissions_cache") as invalidate:
+                self.user.save()
+                self.user.groups.add(group)
+                template.save()
+                self.assertEqual(invalidate.call_count, 0)
+
+    def test_next_action_rank(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 15")
+        approval = CustomFormAction.objects.create(template=template, rank=10, role="is_staff")
+        notification = CustomFormAction.objects.create(
+            template=template, rank=20, role="is_staff", action_type=CustomFormAction.ActionTypes.NOTIFICATION
+        )
+        other_user, other_project = create_user_and_project()
+        custom_forms = [CustomForm.objects.create(template=template, creator=other_user) for i in range(3)]
+        self.assertEqual(custom_forms[0].next_action_rank, 10)
+        with mock.patch.object(CustomForm, "get_next_action_rank") as get_next_action_rank:
+            custom_forms[0].process_action(self.user, approval, "true")
+            # Only updated once, by the action record receiver
+            self.assertEqual(get_next_action_rank.call_count, 0)
+        self.assertEqual(custom_forms[0].next_action_rank, 20)
+        self.assertEqual(custom_forms[0].status, CustomForm.FormStatus.APPROVED)
+        custom_forms[1].process_action(self.user, approval, "true")
+        custom_forms[1].process_action(self.user, notification, "true")
+        self.assertIsNone(CustomForm.objects.get(pk=custom_forms[1].pk).next_action_rank)
+        self.assertEqual(CustomForm.objects.get(pk=custom_forms[1].pk).status, CustomForm.FormStatus.CLOSED)
+        self.assertEqual(set(CustomForm.objects.filter(template=template, next_action_rank=10)), {custom_forms[2]})
+        # Template actions changes are reflected on the forms
+        CustomFormAction.objects.create(template=template, rank=5, role="is_staff")
+        self.assertEqual(
+            list(
+                CustomForm.objects.filter(template=template).order_by("id").values_list("next_action_rank", flat=True)
+            ),
+            [5, 5, 5],
+        )
+        notification.delete()
+        CustomFormAction.objects.filter(rank=5).delete()
+        self.assertEqual(
+            list(
+                CustomForm.objects.filter(template=template).order_by("id").values_list("next_action_rank", flat=True)
+            ),
+            [None, None, 10],
+        )
+
+    def test_keyset_pagination(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 16", view_all_permissions="is_staff")
+        for i in range(7):
+            CustomForm.objects.create(template=template, creator=self.user)
+        expected_ids = list(CustomForm.objects.order_by("-last_updated", "-id").values_list("id", flat=True))
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+        with self.settings(CUSTOM_FORMS_KEYSET_PAGINATION=True):
+            pages, query_string = [], "pp=3"
+            while query_string is not None:
+                page = self.client.get(f"{url}?{query_string}").context["page"]
+                pages.append(page)
+                query_string = page.next_query_string() if page.has_next() else None
+            self.assertEqual(
+                [[form.id for form in page] for page in pages], [expected_ids[:3], expected_ids[3:6], [expected_ids[6]]]
+            )
+            self.assertFalse(pages[0].has_previous())
+            previous_page = self.client.get(f"{url}?{pages[2].previous_query_string()}").context["page"]
+            self.assertEqual([form.id for form in previous_page], expected_ids[3:6])
+            self.assertTrue(previous_page.has_previous())
+            self.assertEqual(previous_page.paginator.count, 7)
+            # Invalid cursors show the first page
+            page = self.client.get(f"{url}?pp=3&after=invalid").context["page"]
+            self.assertEqual([form.id for form in page], expected_ids[:3])
+            with self.settings(CUSTOM_FORMS_ESTIMATED_COUNT=True, CUSTOM_FORMS_ESTIMATED_COUNT_LIMIT=5):
+                response = self.client.get(f"{url}?pp=3")
+                self.assertEqual(response.context["page"].paginator.count, 5)
+                # The limit was reached, there are at least that many forms
+                self.assertContains(response, "5+ forms")
+            with self.settings(CUSTOM_FORMS_ESTIMATED_COUNT=True, CUSTOM_FORMS_ESTIMATED_COUNT_LIMIT=10):
+                self.assertContains(self.client.get(f"{url}?pp=3"), "7 forms")
+
+    def test_template_data_input_is_parsed_once(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 17")
+        custom_form = CustomForm.objects.create(template=template, creator=self.user, template_data='{"name": "A"}')
+        with mock.patch(
+            "NEMO_custom_forms.utilities.get_submitted_user_inputs", return_value={"name": "A"}
+        ) as get_submitted_user_inputs:
+            for i in range(5):
+                self.assertEqual(custom_form.get_template_data_input(), {"name": "A"})
+            self.assertEqual(get_submitted_user_inputs.call_count, 1)
+            # Assigning new data invalidates the parsed input
+            get_submitted_user_inputs.return_value = {"name": "B"}
+            custom_form.template_data = '{"name": "B"}'
+            self.assertEqual(custom_form.get_template_data_input(), {"name": "B"})
+            custom_form.refresh_from_db()
+            self.assertEqual(custom_form.get_template_data_input(), {"name": "B"})
+            self.assertEqual(get_submitted_user_inputs.call_count, 3)
+
+    def test_display_values(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 18", view_all_permissions="is_staff")
+
+        def template_data(pi):
+            return json.dumps(
+                {"pi": {"type": "textbox", "user_input": pi}, "other": {"type": "textbox", "user_input": "x"}}
+            )
+
+        custom_forms = [
+            CustomForm.objects.create(template=template, creator=self.user, template_data=template_data(pi))
+            for pi in ["Smith", "  jones ", "Smithers"]
+        ]
+        # Values are only stored for display columns
+        self.assertFalse(CustomFormDisplayValue.objects.exists())
+        column = CustomFormDisplayColumn.objects.create(template=template, field_name="pi", display_order=1)
+        self.assertEqual(
+            list(CustomFormDisplayValue.objects.order_by("custom_form_id").values_list("value", "normalized_value")),
+            [("Smith", "smith"), ("  jones ", "jones"), ("Smithers", "smithers")],
+        )
+        custom_forms[1].template_data = template_data("Adams")
+        custom_forms[1].save()
+        self.assertEqual(custom_forms[1].get_display_values(), {"pi": "Adams"})
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+        response = self.client.get(url, {"column_filter": "pi", "column_value": "SMITH"})
+        self.assertEqual({form.id for form in response.context["page"]}, {custom_forms[0].id, custom_forms[2].id})
+        response = self.client.get(url, {"o": f"display_value_{column.id}"})
+        self.assertEqual(
+            [form.id for form in response.context["page"]], [custom_forms[1].id, custom_forms[0].id, custom_forms[2].id]
+        )
+        response = self.client.get(url, {"csv": "true", "column_filter": "pi", "column_value": "adams"})
+        self.assertEqual(b"".join(response.streaming_content).decode().count("Adams"), 1)
+        column.delete()
+        self.assertFalse(CustomFormDisplayValue.objects.exists())
+
+    def test_display_values_with_multiple_answers(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 22", view_all_permissions="is_staff")
+        CustomFormDisplayColumn.objects.create(template=template, field_name="samples1", display_order=1)
+        custom_form = CustomForm.objects.create(
+            template=template,
+            creator=self.user,
+            template_data=json.dumps(
+                {"group": {"type": "group", "user_input": {"0": {"samples": ["Silicon", "Gallium  Arsenide"]}}}}
+            ),
+        )
+        self.assertEqual(custom_form.get_display_values(), {"samples1": "Silicon, Gallium  Arsenide"})
+        self.assertEqual(custom_form.customformdisplayvalue_set.get().normalized_value, "silicon, gallium arsenide")
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+        response = self.client.get(url, {"csv": "true", "column_filter": "samples1", "column_value": "SILICON, GAL"})
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(len(rows), 2)
+        self.assertIn("Silicon, Gallium  Arsenide", rows[1])
+
+    def test_custom_forms_list_queries_per_page(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 19", view_all_permissions="is_staff")
+        group = Group.objects.create(name="Approvers")
+        self.user.groups.add(group)
+        approval = CustomFormAction.objects.create(template=template, rank=1, role=str(group.id))
+        CustomFormAction.objects.create(template=template, rank=2, role=str(group.id), self_action_allowed=True)
+        other_user, other_project = create_user_and_project()
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+
+        def add_forms(number):
+            for i in range(number):
+                custom_form = CustomForm.objects.create(template=template, creator=other_user)
+                if i % 2:
+                    custom_form.process_action(self.user, approval, "true")
+
+        add_forms(2)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        add_forms(6)
+        # Progress bars, next actions and permissions of every row are computed without additional queries
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context["page"]), 8)
+        self.assertContains(response, "progress-bar-warning", count=8)
+
+    @skipUnless(connection.vendor == "sqlite", "Uses SQLite query plans")
+    def test_custom_forms_list_query_plans(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 21", view_all_permissions="is_staff")
+        for i in range(3):
+            CustomForm.objects.create(template=template, creator=self.user)
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+        for params, index_name in [
+            ({}, "customform_active_by_template"),
+            ({"only_show_my_requests": "true"}, "customform_active_by_creator"),
+            ({"form_status": CustomForm.FormStatus.PENDING}, "customform_active_by_status"),
+        ]:
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url, params)
+            # The page of forms is read from the matching partial index, without sorting the template's forms
+            page_sql = next(
+                query["sql"]
+                for query in queries
+                if query["sql"].startswith('SELECT "NEMO_custom_forms_customform"."id"') and "LIMIT" in query["sql"]
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN QUERY PLAN {page_sql}")
+                query_plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn(f"USING INDEX {index_name}", query_plan)
+            self.assertNotIn("TEMP B-TREE FOR ORDER BY", query_plan)
+
+    def test_custom_form_progress(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 20")
+        approval = CustomFormAction.objects.create(template=template, rank=1, role="is_staff")
+        notification = CustomFormAction.objects.create(
+            template=template, rank=2, role="is_staff", action_type=CustomFormAction.ActionTypes.NOTIFICATION
+        )
+        other_user, other_project = create_user_and_project()
+        CustomForm.objects.create(template=template, creator=other_user)
+        custom_form = (
+            CustomForm.objects.select_related("creator", "template")
+            .prefetch_related("template__customformaction_set", "customformactionrecord_set")
+            .get(template=template)
+        )
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.assertEqual(custom_form.next_action(), approval)
+                self.assertIsNone(custom_form.get_action_record_for_rank(approval.rank))
+                self.assertTrue(custom_form.can_take_next_action(self.user))
+        # Taking an action resets the progress, even if records were prefetched
+        record = custom_form.process_action(self.user, approval, "true")
+        self.assertEqual(custom_form.get_action_record_for_rank(approval.rank), record)
+        self.assertEqual(custom_form.next_action(), notification)
+        custom_form.process_action(self.user, notification, "true")
+        self.assertIsNone(custom_form.next_action())
+        self.assertEqual(custom_form.status, CustomForm.FormStatus.CLOSED)
+
+    def test_export_custom_forms_csv(self):
+        template = CustomFormPDFTemplate.objects.create(name="Form 21", view_all_permissions="is_staff")
+        approval = CustomFormAction.objects.create(template=template, rank=1, role="is_staff", name="Review")
+        CustomFormDisplayColumn.objects.create(template=template, field_name="pi", display_order=1)
+        other_user, other_project = create_user_and_project()
+        for i in range(3):
+            custom_form = CustomForm.objects.create(
+                template=template,
+                creator=other_user,
+                form_number=f"F-{i}",
+                template_data=json.dumps({"pi": {"type": "textbox", "user_input": f"PI {i}"}}),
+            )
+            if i:
+                custom_form.process_action(self.user, approval, "true")
+        self.client.force_login(self.user)
+        with self.settings(CUSTOM_FORMS_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse("custom_forms", args=[template.id]), {"csv": "true"})
+            rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(rows[0][:6], ["Pi", "Form number", "Created on", "Creator", "Status", "Cancelled on"])
+        self.assertEqual(rows[0][-1], "Review")
+        self.assertEqual([row[0] for row in rows[1:]], ["PI 2", "PI 1", "PI 0"])
+        self.assertEqual([row[1] for row in rows[1:]], ["F-2", "F-1", "F-0"])
+        self.assertTrue(rows[1][-1].endswith(f"by {self.user.username}"))
+        self.assertEqual(rows[3][-1], "")
+        custom_form_id = CustomForm.objects.get(form_number="F-0").id
+        self.assertTrue(rows[3][-2].endswith(reverse("render_custom_form_pdf", args=[custom_form_id])))
+
+    def test_export_custom_forms_typed_formats(self):
+        form_fields = [
+            {"type": "textbox", "name": "pi", "title": "PI"},
+            {"type": "number", "name": "count", "title": "Count"},
+            {
+                "type": "group",
+                "name": "samples",
+                "title": "Samples",
+                "max_number": 2,
+                "questions": [{"type": "float", "name": "weight", "title": "Weight"}],
+            },
+        ]
+        template = CustomFormPDFTemplate.objects.create(
+            name="Form 22", view_all_permissions="is_staff", form_fields=json.dumps(form_fields)
+        )
+        CustomFormDisplayColumn.objects.create(template=template, field_name="pi", display_order=1)
+        template_data = {
+            "pi": {"type": "textbox", "user_input": "Sm\x0bith"},
+            "count": {"type": "number", "user_input": "3"},
+            "samples": {"type": "group", "user_input": {"0": {"weight": "1.5"}}},
+        }
+        custom_form = CustomForm.objects.create(
+            template=template, creator=self.user, form_number="F-1", template_data=json.dumps(template_data)
+        )
+        self.client.force_login(self.user)
+        url = reverse("custom_forms", args=[template.id])
+        response = self.client.get(url, {"export": "jsonl"})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        row = json.loads(lines[0])
+        self.assertEqual(row["pi"], "Sm\x0bith")
+        self.assertEqual(row["count"], 3)
+        self.assertEqual(row["weight1"], 1.5)
+        self.assertIsNone(row["weight2"])
+        self.assertEqual(row["creator"], str(self.user))
+        self.assertEqual(row["creation_time"][:19], custom_form.creation_time.isoformat()[:19])
+        response = self.client.get(url, {"export": "xlsx"})
+        worksheet = load_workbook(BytesIO(b"".join(response.streaming_content))).active
+        rows = list(worksheet.values)
+        self.assertEqual(rows[0][:2], ("Pi", "Form number"))
+        # Control characters are not allowed in Excel, they are removed
+        self.assertEqual(rows[1][:2], ("Smith", "F-1"))
+        self.assertEqual(rows[0][-3:], ("Count", "Weight1", "Weight2"))
+        self.assertEqual(rows[1][-3:], (3, 1.5, None))
+        self.assertIsInstance(rows[1][2], datetime)
+        self.assertEqual(self.client.get(url, {"export": "pdf"}).status_code, 400)
+
+
+class CustomFormNumberSequenceTest(TransactionTestCase):
+    def setUp(self):
+        self.user, self.project = create_user_and_project(is_staff=True)
+
+    def test_concurrent_custom_form_numbers(self):
+        custom_form_template = CustomFormPDFTemplate.objects.create(name="Form 1")
+        automatic_numbering = CustomFormAutomaticNumbering.objects.create(
+            template=custom_form_template, numbering_template="{{ current_number }}", role="is_staff"
+        )
+        threads, numbers_per_thread = 8, 10
+
+        def generate_numbers():
+            try:
+                return [
+                    automatic_numbering.next_custom_form_number(self.user, save=True) for _ in range(numbers_per_thread)
+                ]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(generate_numbers) for _ in range(threads)]
+            form_numbers = [form_number for future in futures for form_number in future.result()]
+        # Every submission got its own number and none were skipped
+        self.assertCountEqual(form_numbers, [str(number) for number in range(1, threads * numbers_per_thread + 1)])
+        self.assertEqual(CustomFormNumberSequence.objects.get().current_number, threads * numbers_per_thread)
+        self.assertEqual(automatic_numbering.next_custom_form_number(self.user), str(threads * numbers_per_thread + 1))
@@ -0,0 +1,249 @@
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from pypdf import PdfReader, PdfWriter
+
+from NEMO_custom_forms import pdf_utils
+from NEMO_custom_forms.models import CustomFormPDFTemplate, CustomFormSpecialMapping
+from NEMO_custom_forms.tests.test_utilities import create_pdf_form
+
+
+STATIC_ROOT = str(Path(pdf_utils.__file__).parent / "static")
+
+
+class PdfDocumentRequestHandler(BaseHTTPRequestHandler):
+    """Serves a PDF document with an ETag, answering conditional requests, and records the requests received"""
+
+    requests = []
+    content = create_pdf_form(["url_document"])
+    etag = '"v1"'
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/missing.pdf":
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            self.send_header("Content-Length", str(len(self.content)))
+            self.send_header("ETag", self.etag)
+            self.send_header("Set-Cookie", "session=secret; Path=/")
+            self.end_headers()
+            self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class PdfUtilsTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+        self.template = CustomFormPDFTemplate.objects.create(
+            name="Pdf form",
+            form=SimpleUploadedFile("form.pdf", create_pdf_form(["name"], ["agree"]), content_type="application/pdf"),
+            form_fields="[]",
+        )
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        pdf_utils.clear_pdf_template_cache()
+
+    def test_pdf_form_metadata_cache(self):
+        cache_key = self.template.pdf_form_cache_key()
+        with mock.patch.object(
+            pdf_utils, "extract_pdf_form_metadata", wraps=pdf_utils.extract_pdf_form_metadata
+        ) as extract:
+            for i in range(3):
+                self.assertEqual(
+                    list(pdf_utils.get_pdf_form_field_names(self.template.form.file, cache_key)), ["name", "agree"]
+                )
+                self.assertEqual(
+                    pdf_utils.get_pdf_form_field_states_for_field(self.template.form.file, "agree", cache_key),
+                    ["/Yes", "/Off"],
+                )
+            self.assertEqual(extract.call_count, 1)
+            pdf_utils.clear_pdf_template_cache(self.template.pk)
+            pdf_utils.get_pdf_form_field_names(self.template.form.file, cache_key)
+            self.assertEqual(extract.call_count, 2)
+        # Only the most recently used templates are kept
+        with override_settings(CUSTOM_FORMS_PDF_TEMPLATE_CACHE_SIZE=2):
+            for i in range(3):
+                pdf_utils.read_pdf_template(self.template.form.file, (f"template {i}", 1))
+            self.assertEqual(pdf_utils.pdf_template_cache.keys(), [("template 1", 1), ("template 2", 1)])
+
+    def test_pdf_form_catalog(self):
+        with mock.patch.object(
+            pdf_utils, "extract_pdf_form_metadata", wraps=pdf_utils.extract_pdf_form_metadata
+        ) as extract:
+            for i in range(3):
+                self.assertEqual(list(self.template.pdf_form_fields()), ["name", "agree"])
+                self.assertEqual(self.template.pdf_form_field_states("agree"), ["/Yes", "/Off"])
+                self.assertIsNone(self.template.pdf_form_field_states("name"))
+            self.assertEqual(extract.call_count, 0)
+            # Replacing the template file updates the catalog
+            self.template.form = SimpleUploadedFile(
+                "form.pdf", create_pdf_form(["first_name", "last_name"]), content_type="application/pdf"
+            )
+            self.template.save()
+            self.template.refresh_from_db()
+            self.assertEqual(list(self.template.pdf_form_fields()), ["first_name", "last_name"])
+            self.assertEqual(self.template.pdf_form_catalog["widgets"][0]["rect"], [50.0, 710.0, 300.0, 740.0])
+            # Fields are stored as a list, so they keep the pdf order whatever the database
+            self.assertEqual(
+                [field["name"] for field in self.template.pdf_form_catalog["fields"]], ["first_name", "last_name"]
+            )
+            # Templates without a catalog get it extracted once
+            CustomFormPDFTemplate.objects.filter(pk=self.template.pk).update(pdf_form_catalog=None)
+            self.template.refresh_from_db()
+            self.assertEqual(list(self.template.pdf_form_fields()), ["first_name", "last_name"])
+            self.assertIsNotNone(CustomFormPDFTemplate.objects.get(pk=self.template.pk).pdf_form_catalog)
+
+    def test_pdf_form_catalog_of_unsaved_upload(self):
+        # Like in the admin, where special mappings are validated before the new template file is saved
+        self.template.form = SimpleUploadedFile("form.pdf", create_pdf_form(["new"]), content_type="application/pdf")
+        with mock.patch(
+            "NEMO_custom_forms.models.extract_pdf_form_metadata", wraps=pdf_utils.extract_pdf_form_metadata
+        ) as extract:
+            self.assertEqual(list(self.template.pdf_form_fields()), ["new"])
+            CustomFormSpecialMapping(
+                template=self.template, field_name="new", field_value=CustomFormSpecialMapping.FieldValue.FORM_CREATOR
+            ).clean()
+            with self.assertRaises(ValidationError):
+                CustomFormSpecialMapping(
+                    template=self.template,
+                    field_name="name",
+                    field_value=CustomFormSpecialMapping.FieldValue.FORM_CREATOR,
+                ).clean()
+            self.template.save()
+            # The uploaded file was only parsed once
+            self.assertEqual(extract.call_count, 1)
+        self.template.refresh_from_db()
+        self.assertEqual(list(self.template.pdf_form_fields()), ["new"])
+
+    @override_settings(STATIC_ROOT=STATIC_ROOT)
+    def test_signature_mappings(self):
+        pdf_form = create_pdf_form(["name", "signature"], pages=2)
+        catalog = pdf_utils.extract_pdf_form_metadata(BytesIO(pdf_form))
+        for widgets in [None, catalog["widgets"]]:
+            filled_pdf = pdf_utils.copy_and_fill_pdf_form(
+                BytesIO(pdf_form), {"name": "Testy"}, {"signature": "Testy McTester"}, widgets=widgets
+            )
+            pages = PdfReader(BytesIO(filled_pdf)).pages
+            self.assertEqual(len(pages[0]["/Resources"]["/XObject"]), 1)
+            self.assertNotIn("/XObject", pages[1].get("/Resources", {}))
+        signature_image = pdf_utils.create_signature_image("Testy McTester", (1250, 150), 240)
+        self.assertTrue(pdf_utils.text_fits_box(signature_image.size, (1250, 150)))
+        self.assertEqual(len(pdf_utils.convert_image_to_pdf_page(signature_image)["/Resources"]["/XObject"]), 1)
+
+    @override_settings(STATIC_ROOT=STATIC_ROOT)
+    def test_fit_text_in_box(self):
+        def linear_fit(text, within_box, max_font_size, padding, font_path=None):
+            # Reference implementation: shrink the font one point at a time until the text fits
+            for font_size in range(max_font_size, 0, -1):
+                if pdf_utils.text_fits_box(pdf_utils.measure_text(text, font_path, font_size, padding), within_box):
+                    return font_size
+
+        signature_font = pdf_utils.staticfiles_storage.path("NEMO_custom_forms/fonts/dancing_script.ttf")
+        for font_path in [None, signature_font]:
+            for text in ["A", "Testy McTester", "Jöhn Über-Longname III"]:
+                for within_box in [(867, 100), (1372, 14), (300, 100), (1250, 150), (40, 8), (5, 5)]:
+                    fit = pdf_utils.fit_text_in_box(text, within_box, 240, (0.2, 0.1), font_path=font_path)
+                    expected = linear_fit(text, within_box, 240, (0.2, 0.1), font_path=font_path)
+                    self.assertEqual(fit and fit[0], expected, (text, within_box, font_path))
+
+        # A size above a non fitting one can still fit because of the padding rounding
+        def measure_text(text, font_path, font_size, padding):
+            return (font_size, 100 if font_size == 86 else font_size, 0, 0)
+
+        with mock.patch.object(pdf_utils, "measure_text", side_effect=measure_text):
+            self.assertEqual(pdf_utils.fit_text_in_box("A", (100, 88), 120, (0.2, 0.1)), (88, (88, 88, 0, 0)))
+        # Fonts are loaded once per path and size
+        self.assertIs(pdf_utils.get_font(signature_font, 20), pdf_utils.get_font(signature_font, 20))
+        self.assertIs(pdf_utils.get_font(None, 20), pdf_utils.get_font(None, 20))
+
+    @override_settings(STATIC_ROOT=STATIC_ROOT)
+    def test_text_pdf_page_cache(self):
+        pdf_utils.text_pdf_page_cache.clear()
+        for i in range(3):
+            self.assertIsNotNone(pdf_utils.create_text_pdf_page("Pending", (300, 100), 400, color="gray"))
+            self.assertIsNotNone(pdf_utils.create_signature_pdf_page("Testy McTester", (1250, 150), 240))
+        self.assertEqual(pdf_utils.text_pdf_page_cache.info()["misses"], 2)
+        self.assertEqual(pdf_utils.text_pdf_page_cache.info()["hits"], 4)
+        with override_settings(CUSTOM_FORMS_TEXT_PDF_PAGE_CACHE_SIZE=1):
+            pdf_utils.create_text_pdf_page("Rejected", (300, 100), 400)
+            self.assertEqual(pdf_utils.text_pdf_page_cache.info()["size"], 1)
+
+    @override_settings(STATIC_ROOT=STATIC_ROOT, CUSTOM_FORMS_TEXT_RENDERING_ENGINE="vector")
+    def test_vector_text_rendering(self):
+        pdf_form = create_pdf_form(["name", "signature", "approval"])
+        filled_pdf = pdf_utils.copy_and_fill_pdf_form(
+            BytesIO(pdf_form),
+            {"name": "Testy"},
+            {"signature": "Testy McTester", "approval": "Jöhn Über"},
+            page_stamp="Pending",
+        )
+        page = PdfReader(BytesIO(filled_pdf)).pages[0]
+        text = page.extract_text()
+        for expected_text in ["Testy McTester", "Jöhn Über", "Pending"]:
+            self.assertIn(expected_text, text)
+        fonts = {font.idnum for font in page["/Resources"]["/Font"].values()}
+        # Signatures share the same embedded font, the stamp uses the default one
+        self.assertEqual(len(fonts), 2)
+        # Characters not supported by the font encoding fall back to the image rendering
+        self.assertIsNotNone(pdf_utils.create_signature_pdf_page("Testy 测试", (1250, 150), 240, writer=PdfWriter()))
+
+    def test_merge_documents_to_file(self):
+        documents = [create_pdf_form(["name"]), create_pdf_form(["name"], pages=2)]
+        with pdf_utils.merge_documents_to_file(documents) as merged_pdf:
+            self.assertFalse(merged_pdf._rolled)
+            self.assertEqual(len(PdfReader(merged_pdf).pages), 3)
+        with override_settings(CUSTOM_FORMS_PDF_MERGE_MAX_MEMORY_SIZE=100):
+            with pdf_utils.merge_documents_to_file(documents) as merged_pdf:
+                # The merged pdf was written to disk
+                self.assertTrue(merged_pdf._rolled)
+                self.assertEqual(len(PdfReader(merged_pdf).pages), 3)
+
+    def test_url_documents(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), PdfDocumentRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        urls = [f"{base_url}/first.pdf", f"{base_url}/second.pdf", f"{base_url}/missing.pdf", f"{base_url}/first.pdf"]
+        PdfDocumentRequestHandler.requests.clear()
+        url_documents = pdf_utils.get_bytes_from_url_documents(urls)
+        self.assertEqual(len(url_documents), 3)
+        self.assertEqual(url_documents[urls[0]], PdfDocumentRequestHandler.content)
+        self.assertEqual(url_documents[urls[1]], PdfDocumentRequestHandler.content)
+        self.assertIsInstance(url_documents[urls[2]], Exception)
+        self.assertEqual(len(PdfDocumentRequestHandler.requests), 3)
+        # Cookies set by document hosts are not kept (and sent with other downloads)
+        self.assertEqual(len(pdf_utils.get_url_document_session().cookies), 0)
+        # Cached documents are validated with a conditional request
+        PdfDocumentRequestHandler.requests.clear()
+        self.assertEqual(pdf_utils.get_bytes_from_url_document(urls[0]), PdfDocumentRequestHandler.content)
+        self.assertEqual(PdfDocumentRequestHandler.requests, [("/first.pdf", '"v1"')])
+        # Changed documents are downloaded again
+        with mock.patch.object(PdfDocumentRequestHandler, "etag", '"v2"'):
+            with mock.patch.object(PdfDocumentRequestHandler, "content", create_pdf_form(["changed"])):
+                self.assertEqual(pdf_utils.get_bytes_from_url_document(urls[0]), PdfDocumentRequestHandler.content)
+        with override_settings(CUSTOM_FORMS_URL_DOCUMENT_CACHE_MAX_SIZE=0):
+            PdfDocumentRequestHandler.requests.clear()
+            pdf_utils.get_bytes_from_url_document(urls[1])
+            self.assertEqual(PdfDocumentRequestHandler.requests, [("/second.pdf", None)])
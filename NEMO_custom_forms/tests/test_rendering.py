@@ -0,0 +1,167 @@
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock
+
+from NEMO.tests.test_utilities import create_user_and_project
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from pypdf import PdfReader
+
+from NEMO_custom_forms import rendering
+from NEMO_custom_forms.models import CustomForm, CustomFormPDFTemplate
+from NEMO_custom_forms.rendering import (
+    RENDERED_PDF_CACHE_FOLDER,
+    RenderingExecutor,
+    get_rendered_custom_form_pdf,
+    get_rendering_executor,
+    schedule_custom_form_pdf_prerender,
+)
+from NEMO_custom_forms.tests.test_utilities import create_pdf_form
+
+
+class CustomFormRenderingTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+        self.user, self.project = create_user_and_project(is_staff=True)
+        self.template = CustomFormPDFTemplate.objects.create(
+            name="Render form",
+            form=SimpleUploadedFile("render.pdf", create_pdf_form(["name"]), content_type="application/pdf"),
+            form_fields='[{"type": "textbox", "name": "name", "title": "Name"}]',
+        )
+        self.custom_form = CustomForm.objects.create(template=self.template, creator=self.user)
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_rendered_pdf_cache(self):
+        with mock.patch.object(rendering, "merge_documents_to_file", wraps=rendering.merge_documents_to_file) as merge:
+            first_render = get_rendered_custom_form_pdf(self.custom_form)
+            self.assertEqual(get_rendered_custom_form_pdf(self.custom_form), first_render)
+            self.assertEqual(merge.call_count, 1)
+            fingerprint = rendering.custom_form_pdf_fingerprint(self.custom_form)
+            self.assertEqual(rendering.list_cached_rendered_pdfs(), [f"{self.custom_form.id}/{fingerprint}.pdf"])
+            # Changing the form invalidates the cache, and the stale render is removed
+            self.custom_form.status = CustomForm.FormStatus.DENIED
+            self.custom_form.save()
+            get_rendered_custom_form_pdf(self.custom_form)
+            self.assertEqual(merge.call_count, 2)
+            self.assertEqual(len(rendering.list_cached_rendered_pdfs()), 1)
+            # Deleting the form removes its renders
+            self.custom_form.delete()
+            self.assertEqual(rendering.list_cached_rendered_pdfs(), [])
+            self.assertEqual(default_storage.listdir(RENDERED_PDF_CACHE_FOLDER), ([], []))
+
+    def test_filled_pdf_template(self):
+        filled_pdf = self.custom_form.get_filled_pdf_template()
+        self.assertEqual(len(PdfReader(BytesIO(filled_pdf)).pages), 1)
+
+    def test_rendered_pdf_cache_eviction(self):
+        with override_settings(CUSTOM_FORMS_RENDERED_PDF_CACHE_MAX_SIZE=1):
+            get_rendered_custom_form_pdf(self.custom_form)
+            self.assertEqual(rendering.list_cached_rendered_pdfs(), [])
+        with override_settings(CUSTOM_FORMS_RENDERED_PDF_CACHE_MAX_SIZE=0):
+            get_rendered_custom_form_pdf(self.custom_form)
+            self.assertEqual(rendering.list_cached_rendered_pdfs(), [])
+
+    def test_rendered_pdf_cache_eviction_interval(self):
+        rendering._rendered_pdf_cache_written = 0
+        with mock.patch.object(rendering, "evict_rendered_pdfs") as evict:
+            # The cache is not listed after every render
+            for i in range(3):
+                get_rendered_custom_form_pdf(CustomForm.objects.create(template=self.template, creator=self.user))
+            self.assertEqual(evict.call_count, 0)
+            rendered_size = rendering._rendered_pdf_cache_written
+            with override_settings(CUSTOM_FORMS_RENDERED_PDF_CACHE_MAX_SIZE=rendered_size * 10):
+                get_rendered_custom_form_pdf(CustomForm.objects.create(template=self.template, creator=self.user))
+                self.assertEqual(evict.call_count, 1)
+                self.assertEqual(rendering._rendered_pdf_cache_written, 0)
+
+    @override_settings(CUSTOM_FORMS_PDF_PRERENDERING=True)
+    def test_pdf_prerendering(self):
+        executor = mock.Mock()
+        with mock.patch.object(rendering, "get_prerender_executor", return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule_custom_form_pdf_prerender(self.custom_form)
+                schedule_custom_form_pdf_prerender(self.custom_form)
+                # Nothing is submitted until the transaction is committed
+                self.assertEqual(executor.submit.call_count, 0)
+        # Only one render is queued for the form
+        self.assertEqual(executor.submit.call_count, 1)
+        worker_function, function, custom_form_id = executor.submit.call_args.args
+        self.assertEqual((function, custom_form_id), (rendering.prerender_custom_form_pdf, self.custom_form.id))
+        function(custom_form_id)
+        self.assertEqual(len(rendering.list_cached_rendered_pdfs()), 1)
+        # The pre-rendered file is streamed without rendering again
+        self.client.force_login(self.user)
+        with mock.patch.object(rendering, "merge_documents_to_file") as merge:
+            response = self.client.get(reverse("render_custom_form_pdf", args=[self.custom_form.id]))
+            self.assertEqual(merge.call_count, 0)
+        self.assertTrue(response.streaming)
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+
+    @override_settings(CUSTOM_FORMS_RENDERED_PDF_CACHE_MAX_SIZE=0)
+    def test_rendering_executors(self):
+        for executor_type in ["inline", "thread"]:
+            with override_settings(CUSTOM_FORMS_PDF_RENDERING_EXECUTOR=executor_type):
+                self.assertTrue(get_rendered_custom_form_pdf(self.custom_form).startswith(b"%PDF"))
+        with override_settings(CUSTOM_FORMS_PDF_RENDERING_EXECUTOR="thread", CUSTOM_FORMS_PDF_RENDERING_WORKERS=3):
+            self.assertEqual(get_rendering_executor().executor._max_workers, 3)
+            self.assertIs(get_rendering_executor(), get_rendering_executor())
+
+    def test_rendering_executor_queue_limit(self):
+        rendering_executor = RenderingExecutor(ThreadPoolExecutor(1), queue_limit=1)
+        release_first, second_submitted = threading.Event(), threading.Event()
+        rendering_executor.submit(release_first.wait)
+
+        def submit_second():
+            rendering_executor.submit(int)
+            second_submitted.set()
+
+        threading.Thread(target=submit_second).start()
+        # The second submission waits until the first render is done
+        self.assertFalse(second_submitted.wait(0.2))
+        release_first.set()
+        self.assertTrue(second_submitted.wait(5))
+
+    @override_settings(CUSTOM_FORMS_PDF_RENDERING_EXECUTOR="thread", CUSTOM_FORMS_PDF_RENDERING_QUEUE_LIMIT=2)
+    def test_download_custom_forms_pdfs(self):
+        for i in range(4):
+            CustomForm.objects.create(template=self.template, creator=self.user)
+        self.template.view_all_permissions = "is_staff"
+        self.template.save()
+        get_rendered_custom_form_pdf(self.custom_form)
+        self.client.force_login(self.user)
+        with mock.patch.object(rendering, "merge_documents_to_file", wraps=rendering.merge_documents_to_file) as merge:
+            response = self.client.get(reverse("custom_forms", args=[self.template.id]), {"zip": "true"})
+            self.assertTrue(response.streaming)
+            with zipfile.ZipFile(BytesIO(b"".join(response.streaming_content))) as zip_file:
+                file_names = zip_file.namelist()
+                self.assertEqual(len(file_names), 5)
+                self.assertEqual(len(set(file_names)), 5)
+                for file_name in file_names:
+                    self.assertTrue(zip_file.read(file_name).startswith(b"%PDF"))
+            # The form already rendered was served from the cache
+            self.assertEqual(merge.call_count, 4)
+        # The PDFs button keeps the current filters
+        self.custom_form.status = CustomForm.FormStatus.DENIED
+        self.custom_form.save()
+        response = self.client.get(reverse("custom_forms", args=[self.template.id]), {"form_status": 2, "p": 2})
+        zip_url = f"{reverse('custom_forms', args=[self.template.id])}?form_status=2&amp;zip=true"
+        self.assertContains(response, f'href="{zip_url}"')
+        response = self.client.get(reverse("custom_forms", args=[self.template.id]), {"form_status": 2, "zip": "true"})
+        with zipfile.ZipFile(BytesIO(b"".join(response.streaming_content))) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 1)
+        selected = {"zip": "true", "custom_form_ids": [self.custom_form.id]}
+        response = self.client.get(reverse("custom_forms", args=[self.template.id]), selected)
+        with zipfile.ZipFile(BytesIO(b"".join(response.streaming_content))) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 1)
@@ -83,5 +83,7 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": "./test_nemo.db",
+        # Use a file so concurrent connections wait for each other instead of failing with a locked table
+        "TEST": {"NAME": "./test_nemo_test.db"},
     }
 }
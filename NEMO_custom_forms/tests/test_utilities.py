@@ -0,0 +1,71 @@
+from io import BytesIO
+from typing import Iterable
+
+from pypdf import PdfWriter
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    FloatObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
+
+
+def create_pdf_form(text_fields: Iterable[str] = ("name",), checkbox_fields: Iterable[str] = (), pages=1) -> bytes:
+    """Creates a simple fillable PDF with text fields and checkboxes on the first page (and blank extra pages)"""
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(612, 792)
+    first_page = writer.pages[0]
+    fields = ArrayObject()
+    for index, field_name in enumerate([*text_fields, *checkbox_fields]):
+        top = 740 - index * 40
+        field = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Annot"),
+                NameObject("/Subtype"): NameObject("/Widget"),
+                NameObject("/T"): TextStringObject(field_name),
+                NameObject("/Rect"): ArrayObject(
+                    [FloatObject(50), FloatObject(top - 30), FloatObject(300), FloatObject(top)]
+                ),
+                NameObject("/F"): NumberObject(4),
+                NameObject("/P"): first_page.indirect_reference,
+            }
+        )
+        if field_name in checkbox_fields:
+            appearance = DictionaryObject(
+                {
+                    NameObject("/Yes"): writer._add_object(StreamObject()),
+                    NameObject("/Off"): writer._add_object(StreamObject()),
+                }
+            )
+            field[NameObject("/FT")] = NameObject("/Btn")
+            field[NameObject("/V")] = NameObject("/Off")
+            field[NameObject("/AS")] = NameObject("/Off")
+            field[NameObject("/AP")] = DictionaryObject({NameObject("/N"): appearance})
+        else:
+            field[NameObject("/FT")] = NameObject("/Tx")
+            field[NameObject("/DA")] = TextStringObject("/Helv 0 Tf 0 g")
+        fields.append(writer._add_object(field))
+    first_page[NameObject("/Annots")] = ArrayObject(fields)
+    helvetica = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+        }
+    )
+    writer._root_object[NameObject("/AcroForm")] = DictionaryObject(
+        {
+            NameObject("/Fields"): fields,
+            NameObject("/DA"): TextStringObject("/Helv 0 Tf 0 g"),
+            NameObject("/DR"): DictionaryObject(
+                {NameObject("/Font"): DictionaryObject({NameObject("/Helv"): writer._add_object(helvetica)})}
+            ),
+        }
+    )
+    with BytesIO() as buffer:
+        writer.write(buffer)
+        return buffer.getvalue()
@@ -1,8 +1,18 @@
 from __future__ import annotations
 
+import os
 import re
-from collections import defaultdict
-from typing import Any, Dict, List, TYPE_CHECKING, Tuple
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, TYPE_CHECKING, Tuple
+
+from NEMO.constants import CHAR_FIELD_MEDIUM_LENGTH
+from NEMO.utilities import quiet_int
+from NEMO.widgets.dynamic_form import get_submitted_user_inputs
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 
 from NEMO_custom_forms.apps import CustomFormsConfig
 
@@ -15,6 +25,7 @@ CUSTOM_FORM_GROUP_PREFIX = "g#"
 CUSTOM_FORM_USER_PREFIX = "u#"
 
 CUSTOM_FORM_NOTIFICATION = "customform"
+CUSTOM_FORM_PERMISSIONS_CACHE_PREFIX = "custom_forms_template_permissions"
 CUSTOM_FORM_EMAIL_CATEGORY = CustomFormsConfig.plugin_id + 1
 
 
@@ -24,16 +35,80 @@ def default_dict_to_regular_dict(d):
     return d
 
 
+def template_permissions_cache_timeout() -> int:
+    # Number of seconds users' template permissions are cached for, 0 (default) disables the cache.
+    # Invalidation only reaches other processes through the cache itself, so a shared cache backend is required
+    return quiet_int(getattr(settings, "CUSTOM_FORMS_PERMISSIONS_CACHE_TIMEOUT", 0), 0)
+
+
+def template_permissions_cache_key(user_id: int) -> str:
+    # The version changes every time all users' permissions need to be invalidated
+    version = cache.get(f"{CUSTOM_FORM_PERMISSIONS_CACHE_PREFIX}_version", 0)
+    return f"{CUSTOM_FORM_PERMISSIONS_CACHE_PREFIX}_{version}_{user_id}"
+
+
+def get_cached_template_permissions(user_id: int) -> Optional[Tuple[Set[int], Set[int], Set[int]]]:
+    """Returns the cached (creatable, view all, approvable) template ids for the user, if any"""
+    if not template_permissions_cache_timeout():
+        return None
+    return cache.get(template_permissions_cache_key(user_id))
+
+
+def set_cached_template_permissions(user_id: int, template_ids: Tuple[Set[int], Set[int], Set[int]]):
+    timeout = template_permissions_cache_timeout()
+    if timeout:
+        cache.set(template_permissions_cache_key(user_id), template_ids, timeout)
+
+
+def invalidate_template_permissions_cache(user_ids: Iterable[int] = None):
+    """Invalidates the cached template permissions of the given users, or of everyone if no users are given"""
+    if user_ids is None:
+        cache.set(f"{CUSTOM_FORM_PERMISSIONS_CACHE_PREFIX}_version", time.time_ns(), None)
+    else:
+        cache.delete_many([template_permissions_cache_key(user_id) for user_id in user_ids])
+
+
+def parse_template_data_input(template_data: Optional[str]) -> Dict:
+    """Returns the flattened user inputs of a custom form's template data, by field name."""
+    form_inputs = get_submitted_user_inputs(template_data)
+    data_input = {}
+    for question_name, value in form_inputs.items():
+        if isinstance(value, str):
+            data_input[question_name] = value
+        else:
+            for i, input_values in enumerate(value, 1):
+                # special case if it's a list of one string, we set it as if that was just one string
+                # This is especially useful for checkboxes
+                if isinstance(input_values, str) and len(value) == 1:
+                    data_input[f"{question_name}"] = input_values
+                elif isinstance(input_values, dict):
+                    for name, input_value in input_values.items():
+                        data_input[f"{name}{i}"] = input_value
+    return data_input
+
+
+def format_display_value(value: Any) -> str:
+    # Multiple answers (checkboxes in groups for example) are listed, separated by commas
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value)
+    return str(value)
+
+
+def normalize_display_value(value: Any) -> str:
+    # Case-insensitive, with collapsed whitespace and short enough to be indexed
+    return " ".join(format_display_value(value).split()).casefold()[:CHAR_FIELD_MEDIUM_LENGTH]
+
+
 def custom_forms_current_numbers(form_template: CustomFormPDFTemplate) -> Dict:
     automatic_numbering: CustomFormAutomaticNumbering = getattr(form_template, "customformautomaticnumbering", None)
     if not automatic_numbering or not automatic_numbering.enabled:
         return {}
 
-    from NEMO.models import Customization
+    from NEMO_custom_forms.models import CustomFormNumberSequence
 
     form_dict_list = [
-        (split_form_patterns(f.name, automatic_numbering), f.value)
-        for f in Customization.objects.filter(name__startswith=CUSTOM_FORM_CURRENT_NUMBER_PREFIX)
+        (split_form_patterns(f.name, automatic_numbering), str(f.current_number))
+        for f in CustomFormNumberSequence.objects.filter(template=form_template)
         if split_form_patterns(f.name, automatic_numbering)
     ]
     return merge_form_dicts(form_dict_list, automatic_numbering)
@@ -82,3 +157,95 @@ def merge_form_dicts(dict_value_tuples: List[Tuple[dict, Any]], automatic_number
 
     # Convert defaultdict to a regular dict for the final result
     return default_dict_to_regular_dict(merged_dict)
+
+
+class LRUCache:
+    """
+    Thread-safe, in-process least recently used cache keeping track of hits and misses.
+    The maximum number of entries is read from the given setting (0 disables the cache).
+    """
+
+    def __init__(self, max_size_setting: str, default_max_size: int):
+        self.max_size_setting = max_size_setting
+        self.default_max_size = default_max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return quiet_int(getattr(settings, self.max_size_setting, self.default_max_size), self.default_max_size)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        max_size = self.max_size
+        with self._lock:
+            if max_size <= 0:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+
+    def keys(self) -> List:
+        with self._lock:
+            return list(self._data)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "max_size": self.max_size}
+
+
+def list_storage_folder_files(folder: str, recursive=False) -> List[str]:
+    # File paths are relative to the folder, and include the files in sub folders when recursive
+    try:
+        directories, files = default_storage.listdir(folder)
+    except FileNotFoundError:
+        return []
+    if recursive:
+        for directory in directories:
+            files.extend(
+                f"{directory}/{file_name}" for file_name in list_storage_folder_files(f"{folder}/{directory}", True)
+            )
+    return files
+
+
+def touch_storage_file(file_path: str):
+    # Mark the file as recently used so it's evicted last (only possible with local storage)
+    try:
+        os.utime(default_storage.path(file_path))
+    except NotImplementedError:
+        pass
+
+
+def evict_storage_folder_files(folder: str, max_size: int, recursive=False):
+    """Deletes the least recently used files in the folder until its total size is under the given size (in bytes)."""
+    entries = []
+    for file_name in list_storage_folder_files(folder, recursive):
+        file_path = f"{folder}/{file_name}"
+        entries.append((default_storage.get_modified_time(file_path), default_storage.size(file_path), file_path))
+    total_size = sum(size for last_used, size, file_path in entries)
+    for last_used, size, file_path in sorted(entries):
+        if total_size <= max_size:
+            break
+        default_storage.delete(file_path)
+        total_size -= size
@@ -1,16 +1,22 @@
-from collections import OrderedDict, defaultdict
-from typing import Dict, List, Optional, Tuple
+import csv
+import datetime
+import json
+from collections import OrderedDict
+from functools import partial
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from NEMO.decorators import administrator_required
 from NEMO.exceptions import RequiredUnansweredQuestionsException
-from NEMO.models import EmailNotificationType, Notification, User
+from NEMO.models import EmailNotificationType, User
 from NEMO.typing import QuerySetType
 from NEMO.utilities import (
     BasicDisplayTable,
+    capitalize,
     export_format_datetime,
     format_datetime,
     get_full_url,
-    get_model_instance,
     quiet_int,
     render_email_template,
     send_mail,
@@ -18,16 +24,25 @@ from NEMO.utilities import (
 from NEMO.views.customization import get_media_file_contents
 from NEMO.views.notifications import delete_notification
 from NEMO.views.pagination import SortedPaginator
-from NEMO.widgets.dynamic_form import DynamicForm
+from NEMO.widgets.dynamic_form import DynamicForm, PostUsageGroupQuestion
 from django import forms
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.db.models import OuterRef, Prefetch, Q, Subquery
+from django.http import (
+    FileResponse,
+    HttpResponseBadRequest,
+    HttpResponseForbidden,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
+from django.utils import timezone
 from django.views.decorators.http import require_GET, require_http_methods
 
 from NEMO_custom_forms.models import (
@@ -35,37 +50,111 @@ from NEMO_custom_forms.models import (
     CustomFormAction,
     CustomFormActionRecord,
     CustomFormAutomaticNumbering,
+    CustomFormDisplayValue,
     CustomFormDocumentType,
     CustomFormDocuments,
     CustomFormPDFTemplate,
 )
-from NEMO_custom_forms.notifications import create_custom_form_notification
-from NEMO_custom_forms.pdf_utils import merge_documents
+from NEMO_custom_forms.notifications import create_custom_form_notification, get_custom_form_notification_counts
+from NEMO_custom_forms.pagination import get_custom_forms_paginator
+from NEMO_custom_forms.rendering import (
+    open_rendered_custom_form_pdf,
+    schedule_custom_form_pdf_prerender,
+    stream_custom_form_pdfs_zip,
+)
 from NEMO_custom_forms.utilities import (
     CUSTOM_FORM_EMAIL_CATEGORY,
     CUSTOM_FORM_NOTIFICATION,
-    default_dict_to_regular_dict,
+    get_cached_template_permissions,
+    normalize_display_value,
+    set_cached_template_permissions,
 )
 
 
+class CustomFormTemplatePermissions:
+    """
+    Resolves which templates a user can create, view all or approve forms for. Enabled templates are loaded once
+    with their actions, and each role is only checked once. See get_custom_form_template_permissions.
+    The resulting template ids can also be kept in the cache (CUSTOM_FORMS_PERMISSIONS_CACHE_TIMEOUT setting, disabled
+    by default) until templates, actions or the user's roles, groups or permissions change. Since they are used for
+    authorization, only enable it with a cache backend shared by all processes (i.e. not the local memory cache).
+    """
+
+    def __init__(self, user: User):
+        self.user = user
+        self._templates: Optional[List[CustomFormPDFTemplate]] = None
+        self._role_checks: Dict[Tuple, bool] = {}
+        cached_template_ids = get_cached_template_permissions(user.id)
+        if cached_template_ids is not None:
+            self.creatable_ids, self.view_all_ids, self.approvable_ids = cached_template_ids
+        else:
+            self._templates = list(
+                CustomFormPDFTemplate.objects.filter(enabled=True).prefetch_related("customformaction_set")
+            )
+            self.creatable_ids = {template.id for template in self._templates if self._can_create(template)}
+            self.view_all_ids = {template.id for template in self._templates if self._can_view_all(template)}
+            self.approvable_ids = {template.id for template in self._templates if self._can_approve(template)}
+            set_cached_template_permissions(user.id, (self.creatable_ids, self.view_all_ids, self.approvable_ids))
+        self.visible_ids = self.creatable_ids | self.view_all_ids | self.approvable_ids
+
+    @property
+    def templates(self) -> List[CustomFormPDFTemplate]:
+        if self._templates is None:
+            self._templates = list(CustomFormPDFTemplate.objects.filter(enabled=True, id__in=self.visible_ids))
+        return self._templates
+
+    def visible_templates(self) -> List[CustomFormPDFTemplate]:
+        return [template for template in self.templates if template.id in self.visible_ids]
+
+    def creatable_templates(self) -> List[CustomFormPDFTemplate]:
+        return [template for template in self.templates if template.id in self.creatable_ids]
+
+    # The following also work for disabled templates, which are not resolved in advance
+    def can_create(self, template: CustomFormPDFTemplate) -> bool:
+        return template.id in self.creatable_ids if template.enabled else self._can_create(template)
+
+    def can_view_all(self, template: CustomFormPDFTemplate) -> bool:
+        return template.id in self.view_all_ids if template.enabled else self._can_view_all(template)
+
+    def can_approve(self, template: CustomFormPDFTemplate) -> bool:
+        return template.id in self.approvable_ids if template.enabled else self._can_approve(template)
+
+    def _can_create(self, template: CustomFormPDFTemplate) -> bool:
+        field = template.get_create_permissions_field()
+        return any(self._has_role(field, role) for role in field.to_python(template.create_permissions))
+
+    def _can_view_all(self, template: CustomFormPDFTemplate) -> bool:
+        field = template.get_view_all_permissions_field()
+        return any(self._has_role(field, role) for role in field.to_python(template.view_all_permissions))
+
+    def _can_approve(self, template: CustomFormPDFTemplate) -> bool:
+        return any(
+            self._has_role(action.get_role_field(), action.role) for action in template.customformaction_set.all()
+        )
+
+    def _has_role(self, field, role: str) -> bool:
+        # Fields accepting the same kinds of roles give the same answer
+        role_key = (field.roles, field.groups, field.permissions, role)
+        if role_key not in self._role_checks:
+            self._role_checks[role_key] = field.has_user_role(role, self.user)
+        return self._role_checks[role_key]
+
+
+def get_custom_form_template_permissions(user: User) -> CustomFormTemplatePermissions:
+    # Kept on the user object, which only lives for the duration of the request
+    permissions = getattr(user, "_custom_form_template_permissions", None)
+    if permissions is None:
+        permissions = CustomFormTemplatePermissions(user)
+        user._custom_form_template_permissions = permissions
+    return permissions
+
+
 def available_templates_for_user_to_see(user) -> List[CustomFormPDFTemplate]:
-    available_templates = []
-    for available_template in CustomFormPDFTemplate.objects.filter(enabled=True):
-        if (
-            available_template.can_user_create(user)
-            or available_template.can_user_view_all(user)
-            or available_template.can_user_approve(user)
-        ):
-            available_templates.append(available_template)
-    return available_templates
+    return get_custom_form_template_permissions(user).visible_templates()
 
 
 def available_templates_for_user_to_add(user) -> List[CustomFormPDFTemplate]:
-    return [
-        available_template
-        for available_template in CustomFormPDFTemplate.objects.filter(enabled=True)
-        if available_template.can_user_create(user)
-    ]
+    return get_custom_form_template_permissions(user).creatable_templates()
 
 
 def can_view_any_custom_forms(user) -> bool:
@@ -122,13 +211,19 @@ def custom_forms(request, custom_form_template_id=None):
             CustomForm.objects.filter(cancelled=False)
             .filter(template=selected_template)
             .select_related("creator", "template")
-            .prefetch_related("customformdocuments_set", "template__customformaction_set", "customformactionrecord_set")
+            .prefetch_related(
+                "customformdocuments_set",
+                "template__customformaction_set",
+                "customformactionrecord_set",
+                "customformdisplayvalue_set",
+            )
         )
 
+    permissions = get_custom_form_template_permissions(user)
     if (
         only_show_my_requests
-        or not selected_template.can_user_view_all(user)
-        and not selected_template.can_user_approve(user)
+        or not permissions.can_view_all(selected_template)
+        and not permissions.can_approve(selected_template)
     ):
         # Restrict the list to the ones users have created
         custom_form_list = custom_form_list.filter(creator=user)
@@ -138,18 +233,50 @@ def custom_forms(request, custom_form_template_id=None):
         custom_form_list = custom_form_list.filter(status=form_status)
     form_action_rank = quiet_int(request.GET.get("form_action_rank"))
     if form_action_rank:
-        custom_form_list = custom_form_list.exclude(status__in=CustomForm.FormStatus.finished())
-        if form_action_rank == 1:
-            custom_form_list = custom_form_list.filter(customformactionrecord__isnull=True)
-        else:
-            custom_form_list = custom_form_list.filter(
-                customformactionrecord__action_rank__in=[form_action_rank - 1]
-            ).exclude(customformactionrecord__action_rank__in=[form_action_rank])
+        custom_form_list = custom_form_list.exclude(status__in=CustomForm.FormStatus.finished()).filter(
+            next_action_rank=form_action_rank
+        )
 
-    page = SortedPaginator(custom_form_list, request, order_by="-last_updated").get_current_page()
+    custom_form_ids = [quiet_int(custom_form_id) for custom_form_id in request.GET.getlist("custom_form_ids")]
+    if custom_form_ids:
+        custom_form_list = custom_form_list.filter(id__in=custom_form_ids)
 
-    if bool(request.GET.get("csv", False)):
-        return export_custom_forms(request, selected_template, custom_form_list.order_by("-last_updated"))
+    # Display columns are filtered and sorted using their stored (normalized) values
+    display_column_orderings = {
+        column.field_name: f"display_value_{column.id}"
+        for column in selected_template.customformdisplaycolumn_set.all()
+    }
+    column_filter, column_value = request.GET.get("column_filter"), request.GET.get("column_value", "").strip()
+    if column_filter in display_column_orderings and column_value:
+        custom_form_list = custom_form_list.filter(
+            id__in=CustomFormDisplayValue.objects.filter(
+                field_name=column_filter, normalized_value__startswith=normalize_display_value(column_value)
+            ).values("custom_form_id")
+        )
+    for field_name, ordering in display_column_orderings.items():
+        if request.GET.get("o", "").lstrip("-") == ordering:
+            custom_form_list = custom_form_list.alias(
+                **{
+                    ordering: Subquery(
+                        CustomFormDisplayValue.objects.filter(
+                            custom_form_id=OuterRef("pk"), field_name=field_name
+                        ).values("normalized_value")[:1]
+                    )
+                }
+            )
+
+    export_format = request.GET.get("export", "csv" if bool(request.GET.get("csv", False)) else None)
+    if export_format:
+        if export_format not in CUSTOM_FORMS_EXPORT_FORMATS:
+            return HttpResponseBadRequest(f"Unknown export format: {export_format}")
+        return export_custom_forms(
+            request, selected_template, custom_form_list.order_by("-last_updated"), export_format
+        )
+    if bool(request.GET.get("zip", False)):
+        return download_custom_forms_pdfs(custom_form_list.order_by("-last_updated"))
+
+    page = get_custom_forms_paginator(custom_form_list, request).get_current_page()
+    CustomForm.prepare_progress(page)
 
     default_columns = [
         ("form_number", "Form number"),
@@ -161,15 +288,35 @@ def custom_forms(request, custom_form_template_id=None):
     dictionary = {
         "page": page,
         "only_show_my_requests": only_show_my_requests,
-        "user_can_add": selected_template.can_user_create(user),
-        "user_can_view_all": selected_template.can_user_view_all(user),
+        "user_can_add": permissions.can_create(selected_template),
+        "user_can_view_all": permissions.can_view_all(selected_template),
         "template_columns": get_ordered_columns(selected_template, default_columns),
         "default_columns": default_columns,
+        "display_column_orderings": display_column_orderings,
+        "selected_column_filter": column_filter,
+        "selected_column_value": column_value,
+        # Exports and PDFs downloads keep the current filters
+        "download_query_strings": {
+            **{
+                export_format: get_filters_query_string(request, export=export_format)
+                for export_format in CUSTOM_FORMS_EXPORT_FORMATS
+            },
+            "zip": get_filters_query_string(request, zip="true"),
+        },
         **get_dictionary_for_base(request, selected_template),
     }
     return render(request, "NEMO_custom_forms/custom_forms.html", dictionary)
 
 
+def get_filters_query_string(request, **params) -> str:
+    # The current query string without pagination and download parameters, with the given parameters added
+    query = request.GET.copy()
+    for key in ["p", "pp", "after", "before", "export", "csv", "zip"]:
+        query.pop(key, None)
+    query.update(params)
+    return query.urlencode()
+
+
 # Reorder columns to fill in the gaps with the provided default columns
 def get_ordered_columns(selected_template: CustomFormPDFTemplate, default_columns: List[Tuple[str, str]]) -> Dict:
     template_columns = {
@@ -210,13 +357,6 @@ def custom_form_templates(request):
 
 
 def get_dictionary_for_base(request, template: CustomFormPDFTemplate = None) -> Dict:
-    # Grab and organize notifications by template
-    notifications = Notification.objects.filter(notification_type=CUSTOM_FORM_NOTIFICATION, user=request.user)
-    custom_form_notifications = defaultdict(int)
-    for notification in notifications:
-        custom_form = get_model_instance(notification.content_type, notification.object_id)
-        custom_form_notifications[custom_form.template_id] += 1
-
     return {
         "title": f"{template.name} forms" if template else "Template list",
         "selected_template": template,
@@ -224,11 +364,147 @@ def get_dictionary_for_base(request, template: CustomFormPDFTemplate = None) ->
         "selected_status": request.GET.get("form_status"),
         "selected_action_rank": request.GET.get("form_action_rank"),
         "form_templates": available_templates_for_user_to_see(request.user),
-        "custom_form_notifications": default_dict_to_regular_dict(custom_form_notifications),
+        # Notifications organized by template
+        "custom_form_notifications": get_custom_form_notification_counts(request.user),
     }
 
 
-def export_custom_forms(request, selected_template: CustomFormPDFTemplate, custom_form_list: QuerySetType[CustomForm]):
+CUSTOM_FORMS_EXPORT_FORMATS = ["csv", "jsonl", "xlsx"]
+
+
+def export_custom_forms(
+    request,
+    selected_template: CustomFormPDFTemplate,
+    custom_form_list: QuerySetType[CustomForm],
+    export_format: str = "csv",
+):
+    # Rows are generated and written one at a time, so large exports use a constant amount of memory
+    filename = f"custom_forms_{export_format_datetime()}.{export_format}"
+    if export_format == "jsonl":
+        return export_custom_forms_jsonl(request, selected_template, custom_form_list, filename)
+    if export_format == "xlsx":
+        return export_custom_forms_xlsx(request, selected_template, custom_form_list, filename)
+    table = get_custom_forms_export_table(selected_template)
+    writer = csv.writer(Echo())
+    csv_rows = chain(
+        [[capitalize(display) for key, display in table.headers]],
+        (
+            [table.formatted_value(row.get(key, "")) for key, display in table.headers]
+            for row in iter_custom_forms_export_rows(request, selected_template, custom_form_list)
+        ),
+    )
+    response = StreamingHttpResponse((writer.writerow(row) for row in csv_rows), content_type="text/csv")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def export_custom_forms_jsonl(
+    request, selected_template: CustomFormPDFTemplate, custom_form_list: QuerySetType[CustomForm], filename: str
+) -> StreamingHttpResponse:
+    # One JSON object per form, keyed by column (dynamic data is keyed by field name)
+    table = get_custom_forms_export_table(selected_template, template_data=True)
+    json_lines = (
+        json.dumps({key: row.get(key) for key, display in table.headers}, cls=ExportJSONEncoder) + "\n"
+        for row in iter_custom_forms_export_rows(request, selected_template, custom_form_list, typed=True)
+    )
+    response = StreamingHttpResponse(json_lines, content_type="application/jsonl")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def export_custom_forms_xlsx(
+    request, selected_template: CustomFormPDFTemplate, custom_form_list: QuerySetType[CustomForm], filename: str
+) -> FileResponse:
+    from openpyxl import Workbook
+
+    table = get_custom_forms_export_table(selected_template, template_data=True)
+    # Write-only workbooks keep rows in a temporary file instead of in memory
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(title="Custom forms")
+    worksheet.append([capitalize(display) for key, display in table.headers])
+    for row in iter_custom_forms_export_rows(request, selected_template, custom_form_list, typed=True):
+        worksheet.append([xlsx_value(row.get(key)) for key, display in table.headers])
+    max_memory_size = quiet_int(getattr(settings, "CUSTOM_FORMS_EXPORT_MAX_MEMORY_SIZE", 5 * 1024 * 1024), 0)
+    output = SpooledTemporaryFile(max_size=max_memory_size)
+    workbook.save(output)
+    output.seek(0)
+    return FileResponse(
+        output,
+        as_attachment=True,
+        filename=filename,
+        content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
+def xlsx_value(value):
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    # Excel doesn't support timezones, so dates are exported in local time
+    if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return timezone.localtime(value).replace(tzinfo=None)
+    if isinstance(value, list):
+        value = ", ".join(str(item) for item in value)
+    elif value is not None and not isinstance(value, (str, int, float, bool, datetime.date)):
+        value = str(value)
+    if isinstance(value, str):
+        # Control characters (from pasted text for example) are not allowed in Excel cells
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    return value
+
+
+class ExportJSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # Dates, decimals etc. are handled by Django, anything else (users for example) is exported as text
+        try:
+            return super().default(o)
+        except TypeError:
+            return str(o)
+
+
+class Echo:
+    """An object implementing just the write method of the file-like interface, so csv writers return their rows"""
+
+    def write(self, value):
+        return value
+
+
+def get_template_data_fields(selected_template: CustomFormPDFTemplate) -> Dict[str, str]:
+    """Returns the question type of each (flattened) field of the template's dynamic form, by field name"""
+    fields = {}
+    try:
+        questions = DynamicForm(selected_template.form_fields).questions
+    except Exception:
+        # Errors in the form fields are reported when the form itself is displayed
+        return fields
+    for question in questions:
+        if isinstance(question, PostUsageGroupQuestion):
+            # Group answers are flattened as field name + index, for as many groups as allowed
+            for i in range(1, (quiet_int(question.max_number, 1) or 1) + 1):
+                for sub_question in question.sub_questions:
+                    fields[f"{sub_question.name}{i}"] = sub_question.type
+        else:
+            fields[question.name] = question.type
+    return fields
+
+
+def typed_template_data_value(question_type: str, value):
+    try:
+        if value not in [None, ""] and question_type in ["number", "rating"]:
+            return int(value)
+        elif value not in [None, ""] and question_type in ["float", "formula"]:
+            return float(value)
+    except (TypeError, ValueError):
+        pass
+    return value
+
+
+def get_custom_forms_export_table(
+    selected_template: CustomFormPDFTemplate, template_data: bool = False
+) -> BasicDisplayTable:
+    """
+    Returns a table with the export columns of the template, rows are generated by iter_custom_forms_export_rows.
+    With template_data, every field of the template's dynamic form is added as well.
+    """
     table = BasicDisplayTable()
     default_columns = [
         ("form_number", "Form number"),
@@ -245,33 +521,84 @@ def export_custom_forms(request, selected_template: CustomFormPDFTemplate, custo
     table.add_header(("document", "Document")),
     for action in selected_template.customformaction_set.all():
         table.add_header((f"action_{action.id}", action.label))
-    for custom_form in custom_form_list:
+    if template_data:
+        for field_name in get_template_data_fields(selected_template):
+            table.add_header((field_name, field_name))
+    return table
+
+
+def iter_custom_forms_export_rows(
+    request,
+    selected_template: CustomFormPDFTemplate,
+    custom_form_list: QuerySetType[CustomForm],
+    typed: bool = False,
+) -> Iterator[Dict]:
+    """
+    Generates the export row of each form. Values are formatted for display (csv), or typed: dates are kept as is
+    and all the dynamic form fields are included, converted to numbers where the question type allows it.
+    """
+    chunk_size = quiet_int(getattr(settings, "CUSTOM_FORMS_EXPORT_CHUNK_SIZE", 500), 500)
+    # Everything that doesn't depend on the form is computed once
+    actions = list(selected_template.customformaction_set.all())
+    template_columns = [column[0] for column in get_ordered_columns(selected_template, []).values()]
+    template_data_fields = get_template_data_fields(selected_template) if typed else {}
+    document_url = get_full_url(reverse("render_custom_form_pdf", args=[0]), request).replace("/0/", "/{}/")
+    custom_form_list = (
+        custom_form_list.select_related("creator", "cancelled_by")
+        .prefetch_related(None)
+        .prefetch_related(
+            Prefetch(
+                "customformactionrecord_set",
+                queryset=CustomFormActionRecord.objects.select_related("action_taken_by"),
+            ),
+            "customformdisplayvalue_set",
+        )
+    )
+    for custom_form in custom_form_list.iterator(chunk_size=chunk_size):
+        cancellation_time = custom_form.cancellation_time if custom_form.cancelled else None
         row = {
             "form_number": custom_form.form_number,
-            "creation_time": format_datetime(custom_form.creation_time, "SHORT_DATETIME_FORMAT"),
+            "creation_time": (
+                custom_form.creation_time
+                if typed
+                else format_datetime(custom_form.creation_time, "SHORT_DATETIME_FORMAT")
+            ),
             "creator": custom_form.creator,
             "status": custom_form.get_status_display(),
             "cancelled": (
-                format_datetime(custom_form.cancellation_time, "SHORT_DATE_FORMAT") if custom_form.cancelled else ""
+                cancellation_time
+                if typed
+                else format_datetime(cancellation_time, "SHORT_DATE_FORMAT") if cancellation_time else ""
             ),
             "cancelled_by": custom_form.cancelled_by,
             "cancellation_reason": custom_form.cancellation_reason,
             "notes": custom_form.notes or "",
-            "document": get_full_url(reverse("render_custom_form_pdf", args=[custom_form.pk]), request),
+            "document": document_url.format(custom_form.pk),
         }
-        data_input = custom_form.get_template_data_input()
-        for key in get_ordered_columns(selected_template, []).values():
-            row[key[0]] = data_input.get(key[0])
-        for action in selected_template.customformaction_set.all():
+        if typed:
+            data_input = custom_form.get_template_data_input()
+            for field_name, question_type in template_data_fields.items():
+                row[field_name] = typed_template_data_value(question_type, data_input.get(field_name))
+        display_values = custom_form.get_display_values()
+        for field_name in template_columns:
+            # Typed exports already have the (typed) value of the template's dynamic form fields
+            if field_name not in template_data_fields:
+                row[field_name] = display_values.get(field_name)
+        for action in actions:
             action_record = custom_form.get_action_record_for_rank(action.rank)
             if action_record:
                 row[f"action_{action.id}"] = (
                     f'{format_datetime(action_record.action_time, "SHORT_DATE_FORMAT")} by {action_record.action_taken_by.username}'
                 )
-        table.add_row(row)
-    filename = f"custom_forms_{export_format_datetime()}.csv"
-    response = table.to_csv()
-    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        yield row
+
+
+def download_custom_forms_pdfs(custom_form_list: QuerySetType[CustomForm]) -> StreamingHttpResponse:
+    # Forms are rendered in parallel and streamed one by one into the zip file
+    response = StreamingHttpResponse(
+        stream_custom_form_pdfs_zip(custom_form_list.iterator(chunk_size=100)), content_type="application/zip"
+    )
+    response["Content-Disposition"] = f'attachment; filename="custom_forms_{export_format_datetime()}.zip"'
     return response
 
 
@@ -386,12 +713,16 @@ def create_custom_form(request, custom_form_template_id=None, custom_form_id=Non
                                 document=f, custom_form=custom_form, document_type=document_type
                             )
                         CustomFormDocuments.objects.filter(id__in=request.POST.getlist("remove_documents")).delete()
+                    # Emails are sent once committed, so the form number sequence isn't locked while sending them
                     if action:
                         delete_notification(CUSTOM_FORM_NOTIFICATION, custom_form.id)
                         action_record = custom_form.process_action(user, action, request.POST.get("action_result"))
-                        send_custom_form_status_update(action_record, action.notification_email)
+                        transaction.on_commit(
+                            partial(send_custom_form_status_update, action_record, action.notification_email)
+                        )
                     create_custom_form_notification(custom_form)
-                    send_custom_form_notification_email(custom_form, edit)
+                    transaction.on_commit(partial(send_custom_form_notification_email, custom_form, edit))
+                    schedule_custom_form_pdf_prerender(custom_form)
                 return redirect("custom_forms", custom_form_template_id=custom_form.template_id)
             else:
                 if request.FILES.getlist("form_documents") or request.POST.get("remove_documents"):
@@ -432,22 +763,21 @@ def delete_custom_form(request, custom_form_id):
 def render_custom_form_pdf(request, custom_form_id):
     user: User = request.user
     custom_form = get_object_or_404(CustomForm, pk=custom_form_id)
+    permissions = get_custom_form_template_permissions(user)
     if (
-        not custom_form.template.can_user_view_all(user)
-        and not custom_form.template.can_user_approve(user)
+        not permissions.can_view_all(custom_form.template)
+        and not permissions.can_approve(custom_form.template)
         and not custom_form.creator == user
     ):
         return redirect("landing")
 
-    merged_pdf_bytes = merge_documents(
-        [custom_form.get_filled_pdf_template(), *custom_form.customformdocuments_set.all()]
+    return FileResponse(
+        open_rendered_custom_form_pdf(custom_form),
+        as_attachment=True,
+        filename=f"{custom_form.rendered_filename()}.pdf",
+        content_type="application/pdf",
     )
 
-    pdf_response = HttpResponse(content_type="application/pdf")
-    pdf_response["Content-Disposition"] = f"attachment; filename={custom_form.rendered_filename()}.pdf"
-    pdf_response.write(merged_pdf_bytes)
-    return pdf_response
-
 
 def send_custom_form_notification_email(custom_form: CustomForm, edit):
     # First, send form received to creator